@@ -0,0 +1,193 @@
+import http.client
+import json
+import os
+import queue
+import threading
+import time
+
+import lnd_client
+
+# lncli has no command to subscribe to events, so the daemon modes of
+# rebalance.py and rebalance_fees.py read lnd's REST streams directly.
+# Where lnd is, and how to reach it, is set in lnd_client.py.
+DEBUG = False
+RECONNECT_DELAY = 10  # In seconds
+# Wait this long after a balance changes, so a burst of HTLCs becomes one round of work
+SETTLE_SECONDS = 5
+# Reload every channel this often, in case an event was missed
+RESYNC_INTERVAL = 15 * 60
+
+
+class EventStream:
+    # One long-lived REST subscription, read line by line: lnd sends
+    # every message as one JSON object {"result": {...}} per line
+    def __init__(self, path):
+        self.path = path
+        lnd_dir = lnd_client.find_lnd_dir()
+        if lnd_dir is None:
+            print("Could not find the lnd folder, looked in", ", ".join(lnd_client.LND_DIRS))
+            exit(1)
+        self.tls_cert = os.path.join(lnd_dir, "tls.cert")
+        self.macaroon_path = lnd_client.macaroon_path(lnd_dir, "readonly.macaroon")
+
+    def connect(self):
+        backend = lnd_client.RestBackend(lnd_client.LND_REST_HOST, lnd_client.LND_REST_PORT,
+                                         lnd_client.read_macaroon(self.macaroon_path), self.tls_cert)
+        # no timeout, a quiet node can go a long time without events
+        connection, response = backend.open("GET", self.path, timeout=None)
+        if response.status != 200:
+            connection.close()
+            raise OSError("lnd answered {status} for {path}".format(status=response.status, path=self.path))
+        return connection, response
+
+    def events(self):
+        connection, response = self.connect()
+        try:
+            while True:
+                line = response.readline()
+                if len(line) == 0:
+                    return
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+                message = json.loads(line)
+                if "error" in message:
+                    raise OSError("lnd stream error: {error}".format(error=message["error"]))
+                yield message["result"]
+        finally:
+            connection.close()
+
+
+def subscribe(stream, kind, event_queue):
+    # Runs on its own thread forever. A None event tells the reader that
+    # the stream dropped, so it may have missed something and should resync.
+    while True:
+        try:
+            for event in stream.events():
+                event_queue.put((kind, event))
+        except (OSError, ValueError, http.client.HTTPException) as err:
+            print("Lost the", kind, "stream:", err)
+        event_queue.put((kind, None))
+        time.sleep(RECONNECT_DELAY)
+
+
+def balance_class(channel):
+    balance_ratio = channel.balance_ratio()
+    if balance_ratio < 0.3:
+        return "local"
+    if balance_ratio > 0.7:
+        return "remote"
+    return "balanced"
+
+
+class ChannelTable:
+    # The channels by chan_id, kept current from HTLC events in between reloads
+    def __init__(self, channels):
+        self.channels = {}
+        self.classes = {}
+        self.dirty = False
+        # forwards and sends in flight: htlc key -> (incoming msat, outgoing msat)
+        self.pending_htlcs = {}
+        self.reload(channels)
+
+    def reload(self, channels):
+        self.channels = {}
+        for one in channels:
+            self.channels[one.channel_id] = one
+        self.dirty = False
+        self.pending_htlcs = {}
+
+    def move(self, channel_id, msat):
+        # positive msat moves sats to our side
+        one = self.channels.get(channel_id)
+        if one is None:
+            return
+        sats = int(msat / 1000)
+        one.local_balance += sats
+        one.remote_balance -= sats
+
+    def apply_htlc_event(self, event):
+        incoming = event.get("incoming_channel_id", "0")
+        outgoing = event.get("outgoing_channel_id", "0")
+        key = (incoming, event.get("incoming_htlc_id", "0"), outgoing, event.get("outgoing_htlc_id", "0"))
+        if "forward_event" in event:
+            info = event["forward_event"].get("info", {})
+            self.pending_htlcs[key] = (int(info.get("incoming_amt_msat", 0)), int(info.get("outgoing_amt_msat", 0)))
+        elif "settle_event" in event:
+            amounts = self.pending_htlcs.pop(key, None)
+            if amounts is None:
+                # receives carry no amount, so that channel has to be reloaded
+                self.dirty = True
+                return
+            if incoming != "0":
+                self.move(incoming, amounts[0])
+            if outgoing != "0":
+                self.move(outgoing, -amounts[1])
+        elif "forward_fail_event" in event or "link_fail_event" in event:
+            self.pending_htlcs.pop(key, None)
+
+    def apply_channel_event(self, event):
+        # opens, closes and channels going on or offline change the list of channels
+        if event.get("type") in ("OPEN_CHANNEL", "CLOSED_CHANNEL", "ACTIVE_CHANNEL", "INACTIVE_CHANNEL"):
+            self.dirty = True
+
+    def crossed_channels(self):
+        # Channels whose balance class changed since the last call
+        crossed = []
+        for channel_id, one in self.channels.items():
+            new_class = balance_class(one)
+            old_class = self.classes.get(channel_id)
+            if old_class is not None and old_class != new_class:
+                crossed.append(one)
+            self.classes[channel_id] = new_class
+        return crossed
+
+
+def watch_channels(load_channels, on_crossed):
+    # Calls on_crossed(all channels, crossed channels) whenever channels cross
+    # the 0.3 / 0.7 balance thresholds. Runs until the process is stopped.
+    event_queue = queue.Queue()
+    for path, kind in [("/v1/channels/subscribe", "channel"), ("/v2/router/htlcevents", "htlc")]:
+        stream = EventStream(path)
+        threading.Thread(target=subscribe, args=(stream, kind, event_queue), daemon=True).start()
+
+    table = ChannelTable(load_channels())
+    table.crossed_channels()
+    last_resync = time.time()
+    changed_since = None
+    print("Watching", len(table.channels), "channels for balance changes")
+    while True:
+        try:
+            kind, event = event_queue.get(timeout=1)
+            if DEBUG:
+                print(kind, event)
+            if event is None:
+                table.dirty = True
+            elif kind == "htlc":
+                table.apply_htlc_event(event)
+            else:
+                table.apply_channel_event(event)
+            if changed_since is None:
+                changed_since = time.time()
+        except queue.Empty:
+            pass
+        now = time.time()
+        resync_due = now - last_resync >= RESYNC_INTERVAL
+        settled = changed_since is not None and now - changed_since >= SETTLE_SECONDS
+        if not settled and not resync_due:
+            continue
+
+        if table.dirty or resync_due:
+            table.reload(load_channels())
+            last_resync = time.time()
+        changed_since = None
+        crossed = table.crossed_channels()
+        if len(crossed) == 0:
+            continue
+        on_crossed(list(table.channels.values()), crossed)
+        # the handler moved sats itself: drop what it caused and start again from lnd's numbers
+        while not event_queue.empty():
+            event_queue.get_nowait()
+        table.reload(load_channels())
+        table.crossed_channels()
+        last_resync = time.time()
@@ -0,0 +1,904 @@
+import asyncio
+import atexit
+import base64
+import hashlib
+import http.client
+import json
+import math
+import os
+import re
+import select
+import shlex
+import signal
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlencode
+
+# Everything the scripts ask lnd goes through here. lnd's REST interface is used
+# when its tls.cert and admin.macaroon can be read, over connections that stay open
+# for the whole run. Otherwise every call runs lncli, like the scripts used to.
+DEBUG = False
+USE_REST = True
+LND_REST_HOST = "localhost"
+LND_REST_PORT = 8080
+# The first of these folders that exists is used
+LND_DIRS = ["~/umbrel/app-data/lightning/data/lnd", "~/umbrel/lnd", "~/.lnd"]
+LND_NETWORK = "mainnet"
+REST_POOL_SIZE = 8  # Idle connections kept open for the next request
+REST_TIMEOUT = 60  # In seconds, payments and event streams have their own
+KEYSEND_RECORD_TYPE = "5482373484"
+COMMAND_CONCURRENCY = 8  # lncli commands running at once, across every thread of a script
+# The channels, fee policies and node info are shared between runs of the scripts through
+# SNAPSHOT_PATH, and reused until they are SNAPSHOT_TTL seconds old. Payments and fee
+# updates throw away what they change. An empty path turns the snapshot off.
+SNAPSHOT_PATH = "lnd_client.snapshot"
+SNAPSHOT_TTL = 5 * 60
+# On an umbrel lncli runs inside the lnd container. Starting a docker exec for every
+# command is slow, so a few shells are kept open in the container and reused instead.
+DOCKER_CONTAINER = "lnd"
+USE_DOCKER_BROKER = True
+DOCKER_BROKER_SESSIONS = 4  # Shells kept open, one command runs in each at a time
+
+
+class LndError(Exception):
+    # lnd or lncli refused a request, the message says why
+    pass
+
+
+class Commandline:
+    def __init__(self, command):
+        self.command_args = shlex.split(command)
+        self.output = ""
+        self.error = ""
+        self.exit_code = 0
+        self.timed_out = False
+
+    def run(self, timeout=None):
+        self.submit(timeout).result()
+
+    def submit(self, timeout=None):
+        # Starts the command and returns a concurrent.futures.Future of this Commandline,
+        # filled in once it exits. Cancelling the future kills the command.
+        return command_executor.submit(self, timeout)
+
+    def finish(self, exit_code, stdout, stderr):
+        self.exit_code = exit_code
+        self.output = ""
+        self.error = ""
+        if exit_code == 0:
+            self.output = stdout.decode("utf-8")
+            if len(stderr) > 0:
+                # warnings, like a command run in a terminal would show them
+                sys.stderr.write(stderr.decode("utf-8", "replace"))
+        elif len(stderr) > 0:
+            self.error = stderr.decode("utf-8").strip()
+        else:
+            self.error = stdout.decode("utf-8")
+
+    def finish_timed_out(self, timeout):
+        self.timed_out = True
+        self.finish(-1, b"", "Timed out after {seconds} seconds".format(seconds=timeout).encode("utf-8"))
+
+    def stream(self, chunk_size=65536):
+        # Hands out stdout as it arrives, instead of holding all of it.
+        # stderr goes to a temporary file, so the command can't stall on a full pipe.
+        with tempfile.TemporaryFile() as stderr_file:
+            process = subprocess.Popen(self.command_args, stdout=subprocess.PIPE, stderr=stderr_file)
+            try:
+                for chunk in iter(lambda: process.stdout.read(chunk_size), b""):
+                    yield chunk
+            except GeneratorExit:
+                process.kill()
+                raise
+            finally:
+                process.stdout.close()
+                self.exit_code = process.wait()
+            if self.exit_code != 0:
+                stderr_file.seek(0)
+                self.error = stderr_file.read().decode("utf-8")
+                if len(self.error) == 0:
+                    self.error = "Exited with code {code}".format(code=self.exit_code)
+
+    def run_until(self, timeout, is_finished):
+        # Like run(), but reads the output line by line as it comes. Stops as soon as
+        # is_finished(line) is true, and kills the command after timeout seconds.
+        # stderr goes to a temporary file, like stream() does.
+        with tempfile.TemporaryFile() as stderr_file:
+            process = subprocess.Popen(self.command_args, stdout=subprocess.PIPE, stderr=stderr_file,
+                                       start_new_session=True)
+
+            def kill():
+                self.timed_out = True
+                kill_process_group(process)
+
+            killer = threading.Timer(timeout, kill)
+            killer.start()
+            lines = []
+            try:
+                for line in process.stdout:
+                    if DEBUG:
+                        print(line.decode("utf-8", "replace"), end="")
+                    lines.append(line)
+                    if is_finished(line.decode("utf-8", "replace")):
+                        break
+                try:
+                    exit_code = process.wait(timeout=1)
+                except subprocess.TimeoutExpired:
+                    # the outcome is known, whatever else it prints doesn't matter
+                    kill_process_group(process)
+                    process.wait()
+                    exit_code = 0
+            finally:
+                killer.cancel()
+                process.stdout.close()
+            stderr_file.seek(0)
+            self.finish(exit_code, b"".join(lines), stderr_file.read())
+
+
+class DockerSession:
+    # One shell inside the container. Each command answers with a single line:
+    # a marker, the exit code, then stdout and stderr in base64
+    def __init__(self):
+        # no -t: a terminal would mangle the output
+        self.process = subprocess.Popen(["docker", "exec", "-i", DOCKER_CONTAINER, "sh"], stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self.buffer = b""
+        self.count = 0
+        # still usable after a command timed out, as long as the shell answered
+        self.answering = True
+        # commands are killed with timeout inside the container, closing this shell wouldn't stop them
+        self.send('out=$(mktemp); err=$(mktemp); trap \'rm -f "$out" "$err"\' EXIT; '
+                  'command -v timeout >/dev/null; echo "ready $?"\n')
+        line = self.read_line(time.time() + 30)
+        if line != b"ready 0":
+            self.close()
+            raise OSError("no timeout command in the {container} container".format(container=DOCKER_CONTAINER))
+
+    def send(self, text):
+        self.process.stdin.write(text.encode("utf-8"))
+        self.process.stdin.flush()
+
+    def read_line(self, deadline):
+        # None when the deadline passes first
+        while b"\n" not in self.buffer:
+            wait = None
+            if deadline is not None:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    return None
+            ready, _, _ = select.select([self.process.stdout], [], [], wait)
+            if len(ready) == 0:
+                return None
+            chunk = os.read(self.process.stdout.fileno(), 65536)
+            if len(chunk) == 0:
+                raise OSError("the shell in the {container} container exited".format(container=DOCKER_CONTAINER))
+            self.buffer += chunk
+        line, self.buffer = self.buffer.split(b"\n", 1)
+        return line
+
+    def run(self, arguments, timeout):
+        # (exit code, stdout, stderr), or None after timeout seconds
+        self.count += 1
+        marker = "broker-{count}".format(count=self.count)
+        command = " ".join(shlex.quote(x) for x in arguments)
+        started = time.time()
+        deadline = None
+        if timeout is not None:
+            command = "timeout -s KILL {seconds} {command}".format(seconds=max(int(math.ceil(timeout)), 1),
+                                                                  command=command)
+            # a few seconds more for the shell to report the kill
+            deadline = started + timeout + 5
+        self.send('{command} >"$out" 2>"$err" </dev/null; rc=$?; printf "%s %s " {marker} "$rc"; '
+                  'base64 <"$out" | tr -d "\\n"; printf " "; base64 <"$err" | tr -d "\\n"; echo\n'.format(
+                      command=command, marker=marker))
+        while True:
+            line = self.read_line(deadline)
+            if line is None:
+                self.answering = False
+                return None
+            fields = line.decode("ascii", "replace").split(" ")
+            if len(fields) == 4 and fields[0] == marker:
+                exit_code = int(fields[1])
+                # 137 is SIGKILL, from timeout once the time was up
+                if timeout is not None and exit_code == 137 and time.time() - started >= timeout:
+                    return None
+                return exit_code, base64.b64decode(fields[2]), base64.b64decode(fields[3])
+
+    def close(self):
+        # The end of its input makes the shell exit, and remove its temporary files on the way.
+        # Killing docker exec straight away would leave the shell and its files in the container.
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=2)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+
+
+class DockerBroker:
+    # Hands lncli commands to the shells in DOCKER_CONTAINER, one command per shell at a time.
+    # The command executor calls it, so no more than COMMAND_CONCURRENCY shells are ever busy.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = []
+        self.broken = False
+
+    def handles(self, command_args):
+        return USE_DOCKER_BROKER and not self.broken and command_args[:3] == ["docker", "exec", DOCKER_CONTAINER]
+
+    def take(self):
+        with self.lock:
+            if len(self.idle) > 0:
+                return self.idle.pop()
+        return DockerSession()
+
+    def give_back(self, session):
+        with self.lock:
+            if len(self.idle) < DOCKER_BROKER_SESSIONS:
+                self.idle.append(session)
+                return
+        session.close()
+
+    def run(self, command, arguments, timeout):
+        # Fills in command like Commandline.run() does. False when the shells don't
+        # work in this container, then the caller runs docker exec itself.
+        try:
+            session = self.take()
+            answer = session.run(arguments, timeout)
+        except OSError as err:
+            if DEBUG:
+                print("Can't keep a shell open in the container, using docker exec:", err)
+            self.broken = True
+            return False
+        if answer is None:
+            if session.answering:
+                self.give_back(session)
+            else:
+                session.close()
+            command.finish_timed_out(timeout)
+            return True
+        self.give_back(session)
+        command.finish(*answer)
+        return True
+
+    def close(self):
+        with self.lock:
+            for session in self.idle:
+                session.close()
+            self.idle = []
+
+
+docker_broker = DockerBroker()
+atexit.register(docker_broker.close)
+
+
+def kill_process_group(process):
+    # Commands start in their own process group, so whatever they started dies with them
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+class CommandExecutor:
+    # Runs commands on an asyncio loop in a background thread, so any thread can start
+    # one and wait on its future. At most COMMAND_CONCURRENCY run at the same time,
+    # whether they start a process or go to a shell of the docker broker.
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.lock = threading.Lock()
+        self.loop = None
+        self.semaphore = None
+        # the broker waits on its shells, so it gets threads of its own
+        self.broker_threads = None
+
+    def start(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.broker_threads = ThreadPoolExecutor(max_workers=self.concurrency)
+                threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        return self.loop
+
+    def submit(self, command, timeout):
+        return asyncio.run_coroutine_threadsafe(self.execute(command, timeout), self.start())
+
+    async def execute(self, command, timeout):
+        if self.semaphore is None:
+            # made here, only the loop's thread touches it
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        async with self.semaphore:
+            if docker_broker.handles(command.command_args):
+                handled = await self.loop.run_in_executor(self.broker_threads, docker_broker.run, command,
+                                                          command.command_args[3:], timeout)
+                if handled:
+                    return command
+            process = await asyncio.create_subprocess_exec(*command.command_args, stdin=subprocess.DEVNULL,
+                                                           stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                                           start_new_session=True)
+            try:
+                stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+            except asyncio.TimeoutError:
+                kill_process_group(process)
+                await process.wait()
+                command.finish_timed_out(timeout)
+                return command
+            except asyncio.CancelledError:
+                kill_process_group(process)
+                raise
+        command.finish(process.returncode, stdout, stderr)
+        return command
+
+
+command_executor = CommandExecutor(COMMAND_CONCURRENCY)
+
+
+def hex_to_base64(value):
+    return base64.b64encode(bytes.fromhex(value)).decode("ascii")
+
+
+def base64_to_hex(value):
+    return base64.b64decode(value).hex()
+
+
+def convert_route(route, convert):
+    # lncli shows the bytes in a route as hex, the REST interface as base64
+    route = json.loads(json.dumps(route))
+    for hop in route.get("hops", []):
+        mpp_record = hop.get("mpp_record")
+        if mpp_record:
+            mpp_record["payment_addr"] = convert(mpp_record.get("payment_addr", ""))
+        amp_record = hop.get("amp_record")
+        if amp_record:
+            for key in ("root_share", "set_id"):
+                amp_record[key] = convert(amp_record.get(key, ""))
+        custom_records = hop.get("custom_records")
+        if custom_records:
+            hop["custom_records"] = {key: convert(value) for key, value in custom_records.items()}
+        if hop.get("metadata"):
+            hop["metadata"] = convert(hop["metadata"])
+    return route
+
+
+def payment_failure_reason(text):
+    found = re.search(r"FAILURE_REASON_[A-Z_]+", text)
+    if found is None:
+        return "FAILED"
+    return found.group(0)
+
+
+def last_payment_status(text):
+    # lncli prints a status line for every update, IN_FLIGHT until lnd is done with the payment
+    statuses = re.findall(r"Payment status: ([A-Z_]+)", text)
+    if len(statuses) == 0:
+        return None
+    return statuses[-1]
+
+
+def payment_finished(line):
+    return last_payment_status(line) in ("SUCCEEDED", "FAILED")
+
+
+def payment_status(status, failure_reason="", error=""):
+    # What send_payment returns, whichever way lnd was asked:
+    # status is SUCCEEDED, FAILED or TIMEOUT
+    return {"status": status, "failure_reason": failure_reason, "error": error}
+
+
+class LncliBackend:
+    def __init__(self, lncli):
+        self.lncli = lncli
+
+    def command(self, arguments):
+        command = "{lncli} {arguments}".format(lncli=self.lncli, arguments=arguments)
+        if DEBUG:
+            print(command)
+            print("-" * 15)
+        return Commandline(command)
+
+    def run_json(self, arguments, timeout=None):
+        one_command = self.command(arguments)
+        one_command.run(timeout=timeout)
+        if len(one_command.error) > 0:
+            raise LndError(one_command.error)
+        if len(one_command.output) == 0:
+            # like the REST interface leaving out a field, callers check for what they need
+            return {}
+        return json.loads(one_command.output)
+
+    def stream_json(self, arguments):
+        one_command = self.command(arguments)
+        for chunk in one_command.stream():
+            yield chunk
+        if len(one_command.error) > 0:
+            raise LndError(one_command.error)
+
+    def get_info(self):
+        return self.run_json("getinfo")
+
+    def list_channels(self):
+        return self.run_json("listchannels --active_only --public_only")
+
+    def stream_channels(self):
+        return self.stream_json("listchannels --active_only --public_only")
+
+    def get_chan_info(self, chan_id):
+        return self.run_json("getchaninfo --chan_id {chan_id}".format(chan_id=chan_id))
+
+    def get_node_info(self, pub_key, timeout=None):
+        return self.run_json("getnodeinfo --pub_key {pub_key} --include_channels true".format(pub_key=pub_key),
+                             timeout=timeout)
+
+    def stream_graph(self):
+        return self.stream_json("describegraph")
+
+    def fee_report(self):
+        return self.run_json("feereport")
+
+    def update_chan_policy(self, chan_point, base_fee_msat, fee_rate_ppm, time_lock_delta):
+        return self.run_json("updatechanpolicy --base_fee_msat {base_fee} --fee_rate {fee_rate} "
+                             "--time_lock_delta {timelock} --chan_point {chan_point}".format(
+                                 base_fee=base_fee_msat, fee_rate=(float(fee_rate_ppm) / 1000000),
+                                 timelock=time_lock_delta, chan_point=chan_point))
+
+    def add_invoice(self, amount, memo, expiry):
+        return self.run_json("addinvoice --expiry {expiry} --memo {memo} --amt {amount}".format(
+            expiry=expiry, memo=shlex.quote(memo), amount=amount))
+
+    def query_routes(self, dest, amount, fee_limit=None, outgoing_chan_id=None, last_hop=None, timeout=None):
+        arguments = "queryroutes --dest {dest} --amt {amount}".format(dest=dest, amount=amount)
+        if fee_limit is not None:
+            arguments += " --fee_limit {fee_limit}".format(fee_limit=fee_limit)
+        if outgoing_chan_id is not None:
+            arguments += " --outgoing_chan_id {channel}".format(channel=outgoing_chan_id)
+        if last_hop is not None:
+            arguments += " --last_hop {last_hop}".format(last_hop=last_hop)
+        return self.run_json(arguments, timeout=timeout)
+
+    def build_route(self, amount, hops, outgoing_chan_id):
+        return self.run_json("buildroute --amt {amount} --hops {hops} --outgoing_chan_id {channel}".format(
+            amount=amount, hops=",".join(hops), channel=outgoing_chan_id))
+
+    def send_to_route(self, payment_hash, route):
+        return self.run_json("sendtoroute --payment_hash={payment_hash} --routes={route}".format(
+            payment_hash=payment_hash, route=shlex.quote(json.dumps({"route": route}))))
+
+    def send_payment(self, amount, fee_limit, timeout, give_up_after, outgoing_chan_id, last_hop,
+                     payment_request=None, dest=None):
+        # Pays payment_request, or keysends amount to dest without one
+        if payment_request is None:
+            # lncli makes the preimage locally and sends it in the keysend record
+            arguments = "sendpayment --force --keysend --dest {dest} --amt {amount} ".format(
+                dest=dest, amount=amount)
+        else:
+            arguments = "payinvoice --force "
+        arguments += "--fee_limit {fee_limit} --timeout {timeout}s --allow_self_payment " \
+                     "--outgoing_chan_id {channel} --last_hop {last_hop}".format(
+                         fee_limit=fee_limit, timeout=timeout, channel=outgoing_chan_id, last_hop=last_hop)
+        if payment_request is not None:
+            arguments += " " + payment_request
+        pay_command = self.command(arguments)
+        pay_command.run_until(give_up_after, payment_finished)
+        if pay_command.timed_out:
+            return payment_status("TIMEOUT")
+        if len(pay_command.error) > 0:
+            if pay_command.exit_code != 1:
+                raise LndError(pay_command.error)
+            return payment_status("FAILED", payment_failure_reason(pay_command.error), pay_command.error)
+        status = last_payment_status(pay_command.output)
+        if status == "FAILED":
+            return payment_status("FAILED", payment_failure_reason(pay_command.output), pay_command.output)
+        if status == "SUCCEEDED":
+            return payment_status("SUCCEEDED")
+        if status is not None:
+            # lncli stopped while lnd was still working on it, lnd may settle it later
+            return payment_status("TIMEOUT")
+        if len(pay_command.output) == 0:
+            return payment_status("FAILED", "FAILED")
+        # older lncli versions print the payment without a status line
+        return payment_status("SUCCEEDED")
+
+
+class RestBackend:
+    # Answers are shaped like lncli's JSON, so the scripts can't tell the two apart
+    def __init__(self, host, port, macaroon, tls_cert=None):
+        self.host = host
+        self.port = port
+        self.macaroon = macaroon
+        # without a certificate it's plain HTTP, for a stand-in server
+        self.context = None
+        if tls_cert is not None:
+            self.context = ssl.create_default_context(cafile=tls_cert)
+            # lnd's certificate is self-signed and pinned above, its host names vary by setup
+            self.context.check_hostname = False
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def new_connection(self):
+        if self.context is None:
+            return http.client.HTTPConnection(self.host, self.port)
+        return http.client.HTTPSConnection(self.host, self.port, context=self.context)
+
+    def take_connection(self):
+        with self.lock:
+            if len(self.idle) > 0:
+                return self.idle.pop(), True
+        return self.new_connection(), False
+
+    def give_back(self, connection):
+        with self.lock:
+            if len(self.idle) < REST_POOL_SIZE:
+                self.idle.append(connection)
+                return
+        connection.close()
+
+    def open(self, method, path, body=None, timeout=REST_TIMEOUT):
+        if DEBUG:
+            print(method, path)
+            print("-" * 15)
+        headers = {"Grpc-Metadata-macaroon": self.macaroon}
+        if body is not None:
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        connection, reused = self.take_connection()
+        while True:
+            connection.timeout = timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                return connection, connection.getresponse()
+            except ConnectionError:
+                connection.close()
+                # lnd closed an idle connection, one fresh try
+                if not reused:
+                    raise
+                connection, reused = self.new_connection(), False
+
+    def error_message(self, response, body):
+        try:
+            return json.loads(body)["message"]
+        except (ValueError, KeyError, TypeError):
+            return "lnd answered {status} {reason}".format(status=response.status, reason=response.reason)
+
+    def request(self, method, path, body=None, timeout=REST_TIMEOUT):
+        try:
+            connection, response = self.open(method, path, body=body, timeout=timeout)
+            response_body = response.read()
+        except (OSError, http.client.HTTPException) as err:
+            raise LndError("lnd didn't answer {path}: {error}".format(path=path, error=err))
+        self.give_back(connection)
+        if response.status != 200:
+            raise LndError(self.error_message(response, response_body))
+        return json.loads(response_body)
+
+    def stream_json(self, path, chunk_size=65536):
+        try:
+            connection, response = self.open("GET", path)
+        except (OSError, http.client.HTTPException) as err:
+            raise LndError("lnd didn't answer {path}: {error}".format(path=path, error=err))
+        try:
+            if response.status != 200:
+                raise LndError(self.error_message(response, response.read()))
+            for chunk in iter(lambda: response.read(chunk_size), b""):
+                yield chunk
+        finally:
+            connection.close()
+
+    def get_info(self):
+        return self.request("GET", "/v1/getinfo")
+
+    def list_channels(self):
+        return self.request("GET", "/v1/channels?active_only=true&public_only=true")
+
+    def stream_channels(self):
+        return self.stream_json("/v1/channels?active_only=true&public_only=true")
+
+    def get_chan_info(self, chan_id):
+        return self.request("GET", "/v1/graph/edge/{chan_id}".format(chan_id=chan_id))
+
+    def get_node_info(self, pub_key, timeout=REST_TIMEOUT):
+        return self.request("GET", "/v1/graph/node/{pub_key}?include_channels=true".format(pub_key=pub_key),
+                            timeout=timeout)
+
+    def stream_graph(self):
+        return self.stream_json("/v1/graph")
+
+    def fee_report(self):
+        return self.request("GET", "/v1/fees")
+
+    def update_chan_policy(self, chan_point, base_fee_msat, fee_rate_ppm, time_lock_delta):
+        funding_txid, output_index = chan_point.split(":")
+        return self.request("POST", "/v1/chanpolicy", {
+            "chan_point": {"funding_txid_str": funding_txid, "output_index": int(output_index)},
+            "base_fee_msat": str(base_fee_msat),
+            "fee_rate": float(fee_rate_ppm) / 1000000,
+            "time_lock_delta": int(time_lock_delta)})
+
+    def add_invoice(self, amount, memo, expiry):
+        invoice = self.request("POST", "/v1/invoices", {"value": str(amount), "memo": memo, "expiry": str(expiry)})
+        invoice["r_hash"] = base64_to_hex(invoice["r_hash"])
+        invoice["payment_addr"] = base64_to_hex(invoice.get("payment_addr", ""))
+        return invoice
+
+    def query_routes(self, dest, amount, fee_limit=None, outgoing_chan_id=None, last_hop=None,
+                     timeout=REST_TIMEOUT):
+        parameters = {}
+        if fee_limit is not None:
+            parameters["fee_limit.fixed"] = fee_limit
+        if outgoing_chan_id is not None:
+            parameters["outgoing_chan_id"] = outgoing_chan_id
+        if last_hop is not None:
+            parameters["last_hop_pubkey"] = hex_to_base64(last_hop)
+        path = "/v1/graph/routes/{dest}/{amount}".format(dest=dest, amount=amount)
+        if len(parameters) > 0:
+            path += "?" + urlencode(parameters, quote_via=quote)
+        routes = self.request("GET", path, timeout=timeout)
+        routes["routes"] = [convert_route(route, base64_to_hex) for route in routes.get("routes", [])]
+        return routes
+
+    def build_route(self, amount, hops, outgoing_chan_id):
+        built = self.request("POST", "/v2/router/route", {
+            "amt_msat": str(int(amount) * 1000),
+            "hop_pubkeys": [hex_to_base64(one_hop) for one_hop in hops],
+            "outgoing_chan_id": str(outgoing_chan_id)})
+        built["route"] = convert_route(built["route"], base64_to_hex)
+        return built
+
+    def send_to_route(self, payment_hash, route):
+        attempt = self.request("POST", "/v2/router/route/send", {
+            "payment_hash": hex_to_base64(payment_hash),
+            "route": convert_route(route, hex_to_base64)})
+        if attempt.get("route"):
+            attempt["route"] = convert_route(attempt["route"], base64_to_hex)
+        if attempt.get("preimage"):
+            attempt["preimage"] = base64_to_hex(attempt["preimage"])
+        return attempt
+
+    def send_payment(self, amount, fee_limit, timeout, give_up_after, outgoing_chan_id, last_hop,
+                     payment_request=None, dest=None):
+        # Pays payment_request, or keysends amount to dest without one
+        body = {"fee_limit_sat": str(fee_limit),
+                "timeout_seconds": int(timeout),
+                "outgoing_chan_ids": [str(outgoing_chan_id)],
+                "last_hop_pubkey": hex_to_base64(last_hop),
+                "allow_self_payment": True}
+        if payment_request is None:
+            preimage = os.urandom(32)
+            body["dest"] = hex_to_base64(dest)
+            body["amt"] = str(amount)
+            body["payment_hash"] = base64.b64encode(hashlib.sha256(preimage).digest()).decode("ascii")
+            body["dest_custom_records"] = {KEYSEND_RECORD_TYPE: base64.b64encode(preimage).decode("ascii")}
+        else:
+            body["payment_request"] = payment_request
+
+        deadline = time.time() + give_up_after
+        connection = None
+        try:
+            connection, response = self.open("POST", "/v2/router/send", body=body, timeout=give_up_after)
+            if response.status != 200:
+                error = self.error_message(response, response.read())
+                return payment_status("FAILED", payment_failure_reason(error), error)
+            # one JSON message per line, until the payment succeeds or fails
+            status = None
+            while True:
+                connection.sock.settimeout(max(deadline - time.time(), 0.001))
+                line = response.readline()
+                if len(line) == 0:
+                    if status == "IN_FLIGHT":
+                        # lnd may still settle it later
+                        return payment_status("TIMEOUT")
+                    return payment_status("FAILED", "FAILED", "lnd ended the payment stream")
+                if len(line.strip()) == 0:
+                    continue
+                message = json.loads(line)
+                if DEBUG:
+                    print(message)
+                if "error" in message:
+                    error = message["error"].get("message", str(message["error"]))
+                    return payment_status("FAILED", payment_failure_reason(error), error)
+                payment = message["result"]
+                status = payment.get("status")
+                if status == "SUCCEEDED":
+                    return payment_status("SUCCEEDED")
+                if status == "FAILED":
+                    return payment_status("FAILED", payment.get("failure_reason", "FAILED"))
+        except socket.timeout:
+            return payment_status("TIMEOUT")
+        except (OSError, http.client.HTTPException) as err:
+            raise LndError("lnd didn't answer the payment: {error}".format(error=err))
+        finally:
+            # a payment stream isn't reused, whatever state it was left in
+            if connection is not None:
+                connection.close()
+
+
+class SnapshotBackend:
+    # Answers get_info, list_channels and fee_report from the snapshot file while it's
+    # fresh, and hands everything else to backend
+    def __init__(self, backend, path, ttl):
+        self.backend = backend
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # bumped by every write, so an answer fetched before a write isn't saved after it
+        self.generation = 0
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def load(self):
+        try:
+            with open(self.path) as snapshot_file:
+                return json.load(snapshot_file)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self, snapshot):
+        # other scripts may read it at any moment, so it is swapped in whole
+        temp_path = "{path}.{pid}.tmp".format(path=self.path, pid=os.getpid())
+        try:
+            with open(temp_path, "w") as snapshot_file:
+                json.dump(snapshot, snapshot_file)
+            os.replace(temp_path, self.path)
+        except OSError as err:
+            if DEBUG:
+                print("Failed to save the snapshot", err)
+
+    def cached(self, name, fetch):
+        with self.lock:
+            entry = self.load().get(name)
+            generation = self.generation
+        if entry is not None and time.time() - entry["saved_at"] < self.ttl:
+            if DEBUG:
+                print("Using the saved {name}, {age:0.0f} seconds old".format(
+                    name=name, age=time.time() - entry["saved_at"]))
+            return entry["data"]
+        data = fetch()
+        with self.lock:
+            if generation == self.generation:
+                snapshot = self.load()
+                snapshot[name] = {"saved_at": time.time(), "data": data}
+                self.save(snapshot)
+        return data
+
+    def invalidate(self, *names):
+        with self.lock:
+            self.generation += 1
+            snapshot = self.load()
+            for name in names:
+                snapshot.pop(name, None)
+            self.save(snapshot)
+
+    def get_info(self):
+        return self.cached("info", self.backend.get_info)
+
+    def list_channels(self):
+        return self.cached("channels", self.backend.list_channels)
+
+    def stream_channels(self):
+        # our own channels are a small answer, the snapshot hands it out in one chunk
+        yield json.dumps(self.list_channels()).encode("utf-8")
+
+    def fee_report(self):
+        return self.cached("fees", self.backend.fee_report)
+
+    def update_chan_policy(self, chan_point, base_fee_msat, fee_rate_ppm, time_lock_delta):
+        try:
+            return self.backend.update_chan_policy(chan_point, base_fee_msat, fee_rate_ppm, time_lock_delta)
+        finally:
+            self.invalidate("fees")
+
+    def send_to_route(self, payment_hash, route):
+        attempt = self.backend.send_to_route(payment_hash, route)
+        if attempt.get("status") != "FAILED":
+            self.invalidate("channels")
+        return attempt
+
+    def send_payment(self, amount, fee_limit, timeout, give_up_after, outgoing_chan_id, last_hop,
+                     payment_request=None, dest=None):
+        payment = self.backend.send_payment(amount, fee_limit, timeout, give_up_after, outgoing_chan_id, last_hop,
+                                            payment_request=payment_request, dest=dest)
+        # a payment that timed out may still go through
+        if payment["status"] != "FAILED":
+            self.invalidate("channels")
+        return payment
+
+
+# Found on first use and kept for the life of the process, so a program that runs
+# the scripts over and over doesn't look for lnd every time
+lncli_cmd = None
+discovered_backend = None
+discovery_lock = threading.Lock()
+
+
+def get_lncli():
+    global lncli_cmd
+    if lncli_cmd is not None:
+        return lncli_cmd
+    which_lncli = Commandline("which lncli")
+    which_lncli.run()
+    lncli_alias = "lncli"
+    if len(which_lncli.error) > 0:
+        print("Failed to determine where lncli is located", which_lncli.error)
+        exit(1)
+    elif len(which_lncli.output) > 0:
+        # this should work on non-umbrel nodes (but I haven't tested)
+        lncli_alias = "lncli"
+    else:
+        # docker is for running on the umbrel
+        lncli_alias = "docker exec {container} lncli".format(container=DOCKER_CONTAINER)
+
+    if DEBUG:
+        print("Using {lncli}".format(lncli=lncli_alias))
+    lncli_cmd = lncli_alias
+    return lncli_alias
+
+
+def find_lnd_dir():
+    for lnd_dir in LND_DIRS:
+        lnd_dir = os.path.expanduser(lnd_dir)
+        if os.path.isdir(lnd_dir):
+            return lnd_dir
+    return None
+
+
+def macaroon_path(lnd_dir, name):
+    return os.path.join(lnd_dir, "data", "chain", "bitcoin", LND_NETWORK, name)
+
+
+def read_macaroon(path):
+    with open(path, "rb") as macaroon_file:
+        return macaroon_file.read().hex()
+
+
+def rest_backend(macaroon_name="admin.macaroon"):
+    # None when lnd's files can't be read, or nothing answers on the REST port
+    lnd_dir = find_lnd_dir()
+    if lnd_dir is None:
+        return None
+    tls_cert = os.path.join(lnd_dir, "tls.cert")
+    macaroon_file = macaroon_path(lnd_dir, macaroon_name)
+    if not os.access(tls_cert, os.R_OK) or not os.access(macaroon_file, os.R_OK):
+        return None
+    backend = RestBackend(LND_REST_HOST, LND_REST_PORT, read_macaroon(macaroon_file), tls_cert)
+    try:
+        backend.get_info()
+    except LndError as err:
+        if DEBUG:
+            print("lnd's REST interface didn't answer:", err)
+        return None
+    return backend
+
+
+def discover_backend():
+    # REST when lnd answers on it, lncli otherwise
+    global discovered_backend
+    with discovery_lock:
+        if discovered_backend is None:
+            backend = None
+            if USE_REST:
+                backend = rest_backend()
+                if backend is not None and DEBUG:
+                    print("Using lnd's REST interface on {host}:{port}".format(
+                        host=LND_REST_HOST, port=LND_REST_PORT))
+            if backend is None:
+                backend = LncliBackend(get_lncli())
+            discovered_backend = backend
+    return discovered_backend
+
+
+def connect(snapshot_ttl=None):
+    # snapshot_ttl=0 always asks lnd, but still keeps the snapshot current for the other scripts
+    backend = discover_backend()
+    if len(SNAPSHOT_PATH) == 0:
+        return backend
+    if snapshot_ttl is None:
+        snapshot_ttl = SNAPSHOT_TTL
+    return SnapshotBackend(backend, SNAPSHOT_PATH, snapshot_ttl)
@@ -1,10 +1,40 @@
+import argparse
+import bisect
+import heapq
 import json
-import shlex
-import subprocess
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import lnd_client
 
 DEBUG = False
 DEBUG_FAILURE = False
 FEE_PER_REBALANCE = 20  # In satoshis
+# Instead of FEE_PER_REBALANCE, let each pair spend at most what the move earns back:
+# the fee rate of the inbound channel minus the fee rate of the outgoing channel
+PROFITABLE_FEE_LIMITS = False
+MAX_IN_FLIGHT_PAYMENTS = 1
+USE_FLOW_PLANNER = False
+MIN_REBALANCE_AMOUNT = 10000  # In satoshis, smaller payments are not worth a fee
+MAX_ATTEMPTS_PER_PAIR = 4  # Payment sizes tried per pair before moving on
+# lnd stops trying a payment after PAYMENT_TIMEOUT seconds, but waits for HTLCs
+# already on their way. After PAYMENT_KILL_GRACE more seconds we move on without it.
+PAYMENT_TIMEOUT = 60
+PAYMENT_KILL_GRACE = 30
+# Pay ourselves with keysend instead of an invoice, lnd has to run with accept-keysend=true
+USE_KEYSEND = False
+PLANNER_PAIRS_PER_CHANNEL = 8  # Cheapest counterparts kept for each channel
+PROBE_ROUTES = True
+PROBE_WITH_PAYMENT = False  # Also send an unpayable HTLC along the route to test liquidity
+PROBE_CONCURRENCY = 8
+# Every rebalance result is appended to PAIR_HISTORY_PATH, and counts half as much
+# after each PAIR_HISTORY_HALF_LIFE seconds. Results older than PAIR_HISTORY_MAX_AGE are dropped.
+PAIR_HISTORY_PATH = "rebalance.history"
+PAIR_HISTORY_HALF_LIFE = 6 * 60 * 60
+PAIR_HISTORY_MAX_AGE = 7 * 24 * 60 * 60
+PAIR_HISTORY_SKIP_WEIGHT = 0.5  # Recent failures needed before an amount is skipped
 
 
 class Channel:
@@ -18,6 +48,10 @@ class Channel:
         self.total_satoshis_received = int(record["total_satoshis_received"])
         self.private = bool(record["private"])
         self.active = bool(record["active"])
+        self.channel_point = record["channel_point"]
+        # our own fees, filled in by update_channel_fees
+        self.base_fee_msat = 0
+        self.ppm_fee = 0
 
     # % that is remote
     def balance_ratio(self):
@@ -32,151 +66,797 @@ class Channel:
         return False
 
 
-class Commandline:
-    def __init__(self, command):
-        self.command_args = shlex.split(command)
-        self.output = ""
-        self.error = ""
-        self.exit_code = 0
+class AttemptTimes:
+    # How long each payment attempt took, for the summary after a round
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seconds = []
+        self.timed_out = 0
 
-    def run(self):
+    def add(self, seconds, timed_out):
+        with self.lock:
+            self.seconds.append(seconds)
+            if timed_out:
+                self.timed_out += 1
 
-        try:
-            stdout = subprocess.check_output(self.command_args)
-            stderr = None
-        except subprocess.CalledProcessError as err:
-            # print("+" * 20)
-            # print("Command failure:", err.returncode)
-            # print(err.output.decode("utf-8"))
-            # print("+" * 20)
-            stdout = None
-            stderr = err.output
-            self.exit_code = err.returncode
-
-        if stdout is None:
-            self.output = ""
+    def summary(self):
+        with self.lock:
+            if len(self.seconds) == 0:
+                return None
+            text = ("Spent {total:0.1f} seconds on {count} payment attempts, "
+                    "the slowest took {slowest:0.1f} seconds").format(
+                total=sum(self.seconds), count=len(self.seconds), slowest=max(self.seconds))
+            if self.timed_out > 0:
+                text += ", {count} timed out".format(count=self.timed_out)
+            self.seconds = []
+            self.timed_out = 0
+            return text
+
+
+class RouteProbe:
+    def __init__(self, route):
+        # the first route from queryroutes, kept so it can be handed to sendtoroute
+        self.route = route
+        if "total_fees_msat" in route:
+            self.total_fees_msat = int(route["total_fees_msat"])
         else:
-            self.output = stdout.decode("utf-8")
-        if stderr is None:
-            self.error = ""
+            self.total_fees_msat = int(route.get("total_fees", 0)) * 1000
+        self.hop_count = len(route["hops"])
+
+
+class PaymentResult:
+    # Failures where a smaller payment could still make it
+    LIQUIDITY_FAILURES = ("FAILURE_REASON_NO_ROUTE", "FAILURE_REASON_INSUFFICIENT_BALANCE", "NO_ROOM")
+
+    def __init__(self, amount_paid, failure_reason=""):
+        self.amount_paid = amount_paid
+        self.failure_reason = failure_reason
+
+    def liquidity_failure(self):
+        return self.failure_reason in self.LIQUIDITY_FAILURES
+
+
+class AmountSearch:
+    # Picks the next payment size for one pair: a binary search between the largest
+    # amount that went through and the smallest that failed, growing again after a success
+    def __init__(self, amount, largest_success, smallest_failure):
+        self.largest_success = largest_success
+        self.smallest_failure = smallest_failure
+        self.amount = amount
+        if smallest_failure is not None and amount >= smallest_failure:
+            self.amount = self.below_failure()
+
+    def below_failure(self):
+        if 0 < self.largest_success < self.smallest_failure:
+            return int((self.largest_success + self.smallest_failure) / 2)
+        return int(self.smallest_failure / 2)
+
+    def succeeded(self, amount):
+        self.largest_success = max(self.largest_success, amount)
+        if self.smallest_failure is not None and self.smallest_failure <= amount:
+            self.smallest_failure = None
+        self.amount = amount * 2
+        if self.smallest_failure is not None and self.amount >= self.smallest_failure:
+            self.amount = self.below_failure()
+
+    def failed(self, amount):
+        if self.largest_success >= amount:
+            # it went through before, so the liquidity has moved since
+            self.largest_success = 0
+        if self.smallest_failure is None or amount < self.smallest_failure:
+            self.smallest_failure = amount
+        self.amount = self.below_failure()
+
+
+class PairHistory:
+    # Decayed successes and failures per (outgoing channel, last hop channel),
+    # in power-of-two amount buckets
+    def __init__(self, half_life):
+        self.half_life = half_life
+        # weights are decayed to the start of this run
+        self.now = time.time()
+        # (outgoing, last hop) -> {bucket: [success weight, failure weight]}
+        self.pairs = {}
+        # (outgoing, last hop) -> [largest amount paid, smallest amount failed or None],
+        # from the results of the last half-life
+        self.bounds = {}
+        self.lock = threading.Lock()
+        self.history_file = None
+
+    def add(self, outgoing, last_hop, amount, succeeded, at):
+        weight = 0.5 ** ((self.now - at) / self.half_life)
+        buckets = self.pairs.setdefault((outgoing, last_hop), {})
+        entry = buckets.setdefault(int(amount).bit_length(), [0.0, 0.0])
+        if succeeded:
+            entry[0] += weight
+        else:
+            entry[1] += weight
+        if self.now - at > self.half_life:
+            return
+        bounds = self.bounds.setdefault((outgoing, last_hop), [0, None])
+        if succeeded:
+            bounds[0] = max(bounds[0], amount)
+            if bounds[1] is not None and bounds[1] <= amount:
+                bounds[1] = None
         else:
-            self.error = stderr.decode("utf-8")
+            if bounds[1] is None or amount < bounds[1]:
+                bounds[1] = amount
+            if bounds[0] >= amount:
+                bounds[0] = 0
+
+    def tried_pairs(self):
+        # every (outgoing, last hop) with results in the history
+        with self.lock:
+            return set(self.pairs)
+
+    def amount_bounds(self, outgoing, last_hop):
+        with self.lock:
+            largest_success, smallest_failure = self.bounds.get((outgoing, last_hop), [0, None])
+        return largest_success, smallest_failure
+
+    def weights(self, outgoing, last_hop, amount):
+        # a failure at a smaller amount counts against this amount too,
+        # and a success at a larger amount counts for it
+        amount_bucket = int(amount).bit_length()
+        successes = 0.0
+        failures = 0.0
+        with self.lock:
+            for bucket, (success_weight, failure_weight) in self.pairs.get((outgoing, last_hop), {}).items():
+                if bucket >= amount_bucket:
+                    successes += success_weight
+                if bucket <= amount_bucket:
+                    failures += failure_weight
+        return successes, failures
+
+    def success_estimate(self, outgoing, last_hop, amount):
+        # 1.0 for a pair we know nothing about
+        successes, failures = self.weights(outgoing, last_hop, amount)
+        return (successes + 1) / (successes + failures + 1)
+
+    def suggested_amount(self, outgoing, last_hop, amount, minimum):
+        # Halve the amount while recent failures outweigh successes, 0 means skip the pair
+        while amount >= minimum:
+            successes, failures = self.weights(outgoing, last_hop, amount)
+            if failures < PAIR_HISTORY_SKIP_WEIGHT or successes >= failures:
+                return amount
+            amount = int(amount / 2)
+        return 0
+
+    def record(self, outgoing, last_hop, amount, succeeded):
+        at = time.time()
+        with self.lock:
+            self.add(outgoing, last_hop, amount, succeeded, at)
+            if self.history_file is not None:
+                self.history_file.write(json.dumps([at, outgoing, last_hop, amount, succeeded]) + "\n")
+                self.history_file.flush()
+
+    def load(self, path):
+        kept_lines = []
+        dropped = False
+        try:
+            with open(path) as history_file:
+                for line in history_file:
+                    try:
+                        at, outgoing, last_hop, amount, succeeded = json.loads(line)
+                    except ValueError:
+                        # a run that was killed mid-write leaves half a line behind
+                        dropped = True
+                        continue
+                    if self.now - at > PAIR_HISTORY_MAX_AGE:
+                        dropped = True
+                        continue
+                    self.add(outgoing, last_hop, amount, succeeded, at)
+                    kept_lines.append(line)
+        except OSError:
+            pass
+        if dropped:
+            # compact the file, so it only grows by what a week of runs adds
+            temp_path = path + ".tmp"
+            with open(temp_path, "w") as history_file:
+                history_file.writelines(kept_lines)
+            os.replace(temp_path, path)
+        self.history_file = open(path, "a")
+
+    def close(self):
+        with self.lock:
+            if self.history_file is not None:
+                self.history_file.close()
+                self.history_file = None
+
+
+class BalanceLedger:
+    # Sats promised to payments which are still in flight, per channel,
+    # so payments running at the same time never spend the same balance twice
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.released = threading.Condition(self.lock)
+        self.outgoing = {}
+        self.incoming = {}
+        # both channels of every pair with a payment in flight, so pairs never share a channel
+        self.busy = set()
+
+    def reserve(self, local, remote, sats, wait=False):
+        with self.lock:
+            while wait and (local.channel_id in self.busy or remote.channel_id in self.busy):
+                self.released.wait()
+            if local.channel_id in self.busy or remote.channel_id in self.busy:
+                return False
+            if outgoing_capacity(local) - self.outgoing.get(local.channel_id, 0) < sats:
+                return False
+            if movement_capacity(remote) - self.incoming.get(remote.channel_id, 0) < sats:
+                return False
+            self.outgoing[local.channel_id] = self.outgoing.get(local.channel_id, 0) + sats
+            self.incoming[remote.channel_id] = self.incoming.get(remote.channel_id, 0) + sats
+            self.busy.add(local.channel_id)
+            self.busy.add(remote.channel_id)
+            return True
+
+    def release(self, local, remote, sats, paid_total):
+        with self.lock:
+            self.outgoing[local.channel_id] -= sats
+            self.incoming[remote.channel_id] -= sats
+            self.busy.discard(local.channel_id)
+            self.busy.discard(remote.channel_id)
+            if paid_total > 0:
+                remote.remote_balance -= paid_total
+                remote.local_balance += paid_total
+                local.local_balance -= paid_total
+                local.remote_balance += paid_total
+            self.released.notify_all()
+
+
+class MatchingEngine:
+    # Channels that can take sats, in heaps keyed by how many sats they can still take,
+    # so every outgoing channel gets its next best counterpart in O(log n).
+    # Entries are never changed in place: a channel whose balance moved is pushed again
+    # with a new version, and out of date entries are dropped when they reach the top.
+    def __init__(self, inbound_channels, skim_channels):
+        self.lock = threading.Lock()
+        self.heaps = {"inbound": [], "skim": []}
+        self.versions = {}
+        self.pushed = 0
+        # sorted half remote balances of the inbound channels that are not in use, for counting
+        self.capacities = []
+        self.capacity_of = {}
+        for one in inbound_channels:
+            self.push("inbound", one)
+        for one in skim_channels:
+            self.push("skim", one)
+
+    def push(self, kind, one):
+        version = self.versions.get(one.channel_id, 0) + 1
+        self.versions[one.channel_id] = version
+        # the push counter breaks ties, so channels are never compared
+        heapq.heappush(self.heaps[kind], (-movement_capacity(one), self.pushed, version, one))
+        self.pushed += 1
+        if kind == "inbound":
+            capacity = int(one.remote_balance / 2)
+            self.capacity_of[one.channel_id] = capacity
+            bisect.insort(self.capacities, capacity)
+
+    def count_with_capacity(self, amount):
+        with self.lock:
+            return len(self.capacities) - bisect.bisect_left(self.capacities, amount)
+
+    def take(self, kind, tried, minimum):
+        # Checks out the channel with the most room that the caller hasn't tried yet,
+        # None when no channel has minimum sats of room left
+        heap = self.heaps[kind]
+        found = None
+        skipped = []
+        with self.lock:
+            while len(heap) > 0:
+                entry = heapq.heappop(heap)
+                room, pushed, version, one = entry
+                if self.versions.get(one.channel_id) != version:
+                    continue
+                if -room < minimum:
+                    skipped.append(entry)
+                    break
+                if one.channel_id in tried:
+                    skipped.append(entry)
+                    continue
+                found = one
+                break
+            for entry in skipped:
+                heapq.heappush(heap, entry)
+            if found is not None and kind == "inbound":
+                capacity = self.capacity_of.pop(found.channel_id)
+                del self.capacities[bisect.bisect_left(self.capacities, capacity)]
+        return found
 
+    def give_back(self, kind, one):
+        # Puts a checked out channel back with its new balance, unless it has taken enough
+        with self.lock:
+            if kind == "inbound" and one.balance_ratio() <= 0.35:
+                print("  ", one.channel_id, "is now balanced enough.", "Remote ratio", one.balance_ratio())
+                return
+            if kind == "skim" and one.balance_ratio() <= 0.6:
+                return
+            self.push(kind, one)
 
-def pay_invoice_for_sats_to_remote(invoice, sats, remote):
+
+class FlowNetwork:
+    # Min-cost flow by the primal-dual method: Dijkstra with node potentials
+    # finds the cheapest cost level, then paths at that level are filled until none are left.
+    # Edges are kept in flat lists; edge e ^ 1 is the reverse of edge e.
+    def __init__(self, node_count):
+        self.node_count = node_count
+        self.edges_from = [[] for _ in range(node_count)]
+        self.edge_to = []
+        self.edge_capacity = []
+        self.edge_cost = []
+
+    def add_edge(self, from_node, to_node, capacity, cost):
+        edge = len(self.edge_to)
+        self.edges_from[from_node].append(edge)
+        self.edge_to.append(to_node)
+        self.edge_capacity.append(capacity)
+        self.edge_cost.append(cost)
+        self.edges_from[to_node].append(edge + 1)
+        self.edge_to.append(from_node)
+        self.edge_capacity.append(0)
+        self.edge_cost.append(-cost)
+        return edge
+
+    def flow_on(self, edge):
+        return self.edge_capacity[edge + 1]
+
+    def solve(self, source, sink):
+        # every cost starts out non-negative, so zero potentials are valid
+        potential = [0] * self.node_count
+        edges_from = self.edges_from
+        edge_to = self.edge_to
+        edge_capacity = self.edge_capacity
+        edge_cost = self.edge_cost
+        total_flow = 0
+        while True:
+            distance = [None] * self.node_count
+            settled = [False] * self.node_count
+            distance[source] = 0
+            queue = [(0, source)]
+            while len(queue) > 0:
+                node_distance, node = heapq.heappop(queue)
+                if settled[node]:
+                    continue
+                settled[node] = True
+                # nothing past the sink is needed for this cost level
+                if node == sink:
+                    break
+                node_potential = potential[node] + node_distance
+                for edge in edges_from[node]:
+                    if edge_capacity[edge] <= 0:
+                        continue
+                    to_node = edge_to[edge]
+                    if settled[to_node]:
+                        continue
+                    new_distance = node_potential + edge_cost[edge] - potential[to_node]
+                    if distance[to_node] is None or new_distance < distance[to_node]:
+                        distance[to_node] = new_distance
+                        heapq.heappush(queue, (new_distance, to_node))
+            if not settled[sink]:
+                break
+            # nodes the search didn't settle are at least as far away as the sink,
+            # which keeps every reduced cost non-negative
+            sink_distance = distance[sink]
+            for node in range(self.node_count):
+                if settled[node]:
+                    potential[node] += distance[node]
+                else:
+                    potential[node] += sink_distance
+            total_flow += self.push_admissible(source, sink, potential)
+        return total_flow
+
+    def push_admissible(self, source, sink, potential):
+        # Fill paths of zero reduced-cost edges. Reduced costs are checked as edges are
+        # walked, so only the part of the network near the shortest paths gets looked at.
+        edges_from = self.edges_from
+        edge_to = self.edge_to
+        edge_capacity = self.edge_capacity
+        edge_cost = self.edge_cost
+        # a dead end stays one for the rest of this cost level, the next Dijkstra
+        # finds anything it would have missed
+        dead = [False] * self.node_count
+        on_path = [False] * self.node_count
+        next_edge = [0] * self.node_count
+        pushed = 0
+        while True:
+            path = []
+            node = source
+            on_path[source] = True
+            while node != sink:
+                node_edges = edges_from[node]
+                node_potential = potential[node]
+                index = next_edge[node]
+                to_node = None
+                while index < len(node_edges):
+                    edge = node_edges[index]
+                    to_node = edge_to[edge]
+                    if (edge_capacity[edge] > 0 and not dead[to_node] and not on_path[to_node]
+                            and edge_cost[edge] + node_potential == potential[to_node]):
+                        break
+                    index += 1
+                next_edge[node] = index
+                if index < len(node_edges):
+                    path.append(edge)
+                    on_path[to_node] = True
+                    node = to_node
+                    continue
+                dead[node] = True
+                on_path[node] = False
+                if node == source:
+                    return pushed
+                node = edge_to[path.pop() ^ 1]
+            push = min(edge_capacity[edge] for edge in path)
+            for edge in path:
+                edge_capacity[edge] -= push
+                edge_capacity[edge ^ 1] += push
+                on_path[edge_to[edge]] = False
+            pushed += push
+
+
+def movement_capacity(remote):
     total_capacity = remote.remote_balance + remote.local_balance
     # This is how much we can move before we move beyond 50%
     half_capacity = total_capacity / 2
     # Allow ourselves overshoot balanced: 55% - 45% (local/remote)
     half_capacity = half_capacity * 1.1
-    movement_capacity = half_capacity - remote.local_balance
-    if movement_capacity >= sats:
-        remote_pubkey = remote.remote_pubkey
+    return half_capacity - remote.local_balance
+
+
+def outgoing_capacity(local):
+    # How much can leave before the channel goes past 45% - 55% (local/remote) the other way
+    total_capacity = local.remote_balance + local.local_balance
+    return local.local_balance - total_capacity / 2 * 0.9
+
+
+def fee_limit_for(one_local, one_remote, amount):
+    # The most we can pay, in whole sats, to move amount from one_local to one_remote
+    if not PROFITABLE_FEE_LIMITS:
+        return FEE_PER_REBALANCE
+    # The moved sats will be forwarded out of one_remote instead of one_local
+    margin_ppm = one_remote.ppm_fee - one_local.ppm_fee
+    return int(amount * margin_ppm / 1000000)
+
+
+def pay_invoice_for_sats_to_remote(invoice, sats, remote, outgoing_chan_id, fee_limit):
+    # With no invoice, pay ourselves with keysend instead
+    if movement_capacity(remote) >= sats:
         # This could work for a rebalancing
-        payinvoice = "{lncli} payinvoice --force  --fee_limit {fee_limit} --allow_self_payment " \
-                     "--outgoing_chan_id {channel} --last_hop {remote_pubkey} {invoice}".format(
-                                lncli=lncli_cmd, fee_limit=FEE_PER_REBALANCE, channel=outgoing_chan_id,
-                                remote_pubkey=remote_pubkey, invoice=invoice)
+        started = time.time()
+        try:
+            # keysend makes the preimage on our side, so there is no addinvoice
+            # round trip, and nothing is stored unless it succeeds
+            payment = lnd.send_payment(sats, fee_limit, PAYMENT_TIMEOUT, PAYMENT_TIMEOUT + PAYMENT_KILL_GRACE,
+                                       outgoing_chan_id, remote.remote_pubkey, payment_request=invoice,
+                                       dest=own_pubkey)
+        except lnd_client.LndError as err:
+            print("Failed to pay invoice creation", err)
+            exit(1)
+        seconds = time.time() - started
+        attempt_times.add(seconds, payment["status"] == "TIMEOUT")
         if DEBUG:
-            print(payinvoice)
-            print("==" * 15)
-        pay_command = Commandline(payinvoice)
-        pay_command.run()
-        if len(pay_command.error) > 0:
-            if pay_command.exit_code == 1:
-                if "FAILURE_REASON_NO_ROUTE" in pay_command.error:
-                    if outgoing_chan_id in pay_command.error:
-                        print("  No route found for", remote.channel_id, "- Consider increasing fees.")
-                    else:
-                        print("  No route available for using", remote.channel_id)
+            print("  Payment attempt took {seconds:0.1f} seconds".format(seconds=seconds))
+        if payment["status"] == "TIMEOUT":
+            # lnd may still settle it later, the next run starts from lnd's balances anyway
+            print("  Gave up on", remote.channel_id, "after", int(seconds), "seconds")
+            pair_history.record(outgoing_chan_id, remote.channel_id, sats, False)
+            return PaymentResult(0, "TIMEOUT")
+        if payment["status"] == "FAILED":
+            if payment["failure_reason"] == "FAILURE_REASON_NO_ROUTE" and len(payment["error"]) > 0:
+                if outgoing_chan_id in payment["error"]:
+                    print("  No route found for", remote.channel_id, "- Consider increasing fees.")
                 else:
-                    print("  Could not balance with", remote.channel_id)
-                if DEBUG_FAILURE:
-                    print("+" * 20)
-                    print(pay_command.error)
-                    print("+" * 20)
+                    print("  No route available for using", remote.channel_id)
             else:
-                print("Failed to pay invoice creation", pay_command.error)
-                exit(1)
-            return 0
-        elif len(pay_command.output) > 0:
-            # print("Payment output", pay_command.output)
-            if "Payment status: FAILED" in pay_command.output:
                 # This channel wasn't a good match for the channel we're looking at
                 print("  Could not balance with", remote.channel_id)
-                return 0
-            else:
-                print("  *** Balanced with", remote.channel_id, "- Moved", sats, "sats")
-                return sats
+            if DEBUG_FAILURE and len(payment["error"]) > 0:
+                print("+" * 20)
+                print(payment["error"])
+                print("+" * 20)
+            pair_history.record(outgoing_chan_id, remote.channel_id, sats, False)
+            return PaymentResult(0, payment["failure_reason"])
+        print("  *** Balanced with", remote.channel_id, "- Moved", sats, "sats")
+        pair_history.record(outgoing_chan_id, remote.channel_id, sats, True)
+        return PaymentResult(sats)
     else:
-        return 0
+        return PaymentResult(0, "NO_ROOM")
 
 
-def create_invoice(amt):
-    addinvoice = '{lncli} addinvoice --expiry 600 --memo "Automatic rebalancing" --amt {amount}'.format(
-        lncli=lncli_cmd, amount=amt)
-    # addinvoice = "cat /Users/ray/Desktop/addinvoice.txt"
-    if DEBUG:
-        print(addinvoice)
-        print("-" * 15)
-    add_command = Commandline(addinvoice)
-    add_command.run()
-    invoice_string = ""
-    if len(add_command.error) > 0:
-        print("Failed to run invoice creation", add_command.error)
-        exit(1)
-    elif len(add_command.output) > 0:
-        invoice_json = json.loads(add_command.output)
-        invoice_string = invoice_json["payment_request"]
+def get_last_hop_policy(channel):
+    # The fee our peer charges to forward into this channel is the last-hop fee of a rebalance
+    try:
+        chaninfo_json = lnd.get_chan_info(channel.channel_id)
+    except lnd_client.LndError as err:
+        if DEBUG:
+            print("Failed to get channel info", err)
+        return None
+    if chaninfo_json.get("node1_pub") == channel.remote_pubkey:
+        policy = chaninfo_json.get("node1_policy")
+    else:
+        policy = chaninfo_json.get("node2_policy")
+    if policy is None or policy.get("disabled", False):
+        return None
+    return int(policy.get("fee_base_msat", 0)), int(policy.get("fee_rate_milli_msat", 0))
 
-    if len(invoice_string) == 0:
-        print("Failed to create an invoice")
+
+def pair_success_estimate(local, remote, amount):
+    # Chance that a payment from local out through remote succeeds
+    return pair_history.success_estimate(local.channel_id, remote.channel_id, amount)
+
+
+def plan_rebalance_jobs(rebalance_jobs, inbound_channels):
+    # Model the rebalance as a flow network: outgoing channels supply sats,
+    # inbound channels take up to their 55/45 limit, and each pair costs the
+    # last-hop fee rate (ppm) divided by how likely the pair is to succeed.
+    # The min-cost max-flow moves the most sats for the fewest fee sats.
+    candidates = [one_remote for one_remote in inbound_channels
+                  if movement_capacity(one_remote) >= MIN_REBALANCE_AMOUNT]
+    # one getchaninfo per inbound channel, so ask for them all at once
+    with ThreadPoolExecutor(max_workers=PROBE_CONCURRENCY) as policy_executor:
+        policies = list(policy_executor.map(get_last_hop_policy, candidates))
+    sinks = []
+    for one_remote, policy in zip(candidates, policies):
+        if policy is None:
+            continue
+        sinks.append((one_remote, int(movement_capacity(one_remote)), policy))
+
+    source = 0
+    sink = len(rebalance_jobs) + len(sinks) + 1
+    network = FlowNetwork(sink + 1)
+    for local_index, (one_local, payment_amount) in enumerate(rebalance_jobs):
+        network.add_edge(source, 1 + local_index, payment_amount, 0)
+    for remote_index, (one_remote, room, policy) in enumerate(sinks):
+        network.add_edge(1 + len(rebalance_jobs) + remote_index, sink, room, 0)
+
+    # the most each last hop can take, whichever channel the sats leave from
+    sink_limits = []
+    for remote_index, (one_remote, room, (base_fee_msat, fee_rate_ppm)) in enumerate(sinks):
+        limit = room
+        if not PROFITABLE_FEE_LIMITS:
+            # largest amount whose last-hop fee still fits in our fee limit
+            fee_room_msat = FEE_PER_REBALANCE * 1000 - base_fee_msat
+            if fee_room_msat <= 0:
+                continue
+            if fee_rate_ppm > 0:
+                limit = min(limit, int(fee_room_msat * 1000 / fee_rate_ppm))
+        if limit >= MIN_REBALANCE_AMOUNT:
+            sink_limits.append((remote_index, one_remote, limit, base_fee_msat, fee_rate_ppm))
+
+    # most pairs have never been tried, and those start out at a sure success
+    tried_pairs = pair_history.tried_pairs()
+    pairs_by_local = [[] for _ in rebalance_jobs]
+    pairs_by_remote = [[] for _ in sinks]
+    for local_index, (one_local, payment_amount) in enumerate(rebalance_jobs):
+        local_pairs = pairs_by_local[local_index]
+        for remote_index, one_remote, limit, base_fee_msat, fee_rate_ppm in sink_limits:
+            capacity = min(payment_amount, limit)
+            if capacity < MIN_REBALANCE_AMOUNT or one_remote.channel_id == one_local.channel_id:
+                continue
+            if PROFITABLE_FEE_LIMITS:
+                # the last hop alone has to leave some of the margin over
+                margin_ppm = one_remote.ppm_fee - one_local.ppm_fee
+                if fee_rate_ppm >= margin_ppm:
+                    continue
+                # the base fee only pays off above this amount
+                if capacity * (margin_ppm - fee_rate_ppm) <= base_fee_msat * 1000:
+                    continue
+            success = 1.0
+            if (one_local.channel_id, one_remote.channel_id) in tried_pairs:
+                # don't plan more than the pair managed lately
+                capacity = pair_history.suggested_amount(one_local.channel_id, one_remote.channel_id, capacity,
+                                                         MIN_REBALANCE_AMOUNT)
+                if capacity < MIN_REBALANCE_AMOUNT:
+                    continue
+                success = pair_success_estimate(one_local, one_remote, capacity)
+                if success <= 0:
+                    continue
+            # spread the base fee over the amount, then charge 1 ppm so free hops still rank
+            cost_ppm = fee_rate_ppm + int(base_fee_msat * 1000 / capacity) + 1
+            pair = (int(cost_ppm / success), local_index, remote_index, capacity)
+            local_pairs.append(pair)
+            pairs_by_remote[remote_index].append(pair)
+
+    # A full bipartite graph is too slow to solve for hundreds of channels.
+    # Keep each outgoing channel's cheapest pairs, and let each inbound channel
+    # take the outgoing channels with the fewest pairs so far, so outgoing
+    # channels which all prefer the same cheap last hops still have somewhere else to go.
+    kept_pairs = set()
+    local_degree = [0] * len(rebalance_jobs)
+    for remote_pairs in pairs_by_remote:
+        for pair in heapq.nsmallest(PLANNER_PAIRS_PER_CHANNEL, remote_pairs,
+                                    key=lambda x: (local_degree[x[1]], x[0])):
+            kept_pairs.add(pair)
+            local_degree[pair[1]] += 1
+    for local_pairs in pairs_by_local:
+        kept_pairs.update(heapq.nsmallest(PLANNER_PAIRS_PER_CHANNEL, local_pairs, key=lambda x: x[0]))
+
+    pair_edges = []
+    for cost, local_index, remote_index, capacity in sorted(kept_pairs):
+        edge = network.add_edge(1 + local_index, 1 + len(rebalance_jobs) + remote_index, capacity, cost)
+        pair_edges.append((cost, rebalance_jobs[local_index][0], sinks[remote_index][0], edge))
+
+    network.solve(source, sink)
+
+    planned = []
+    for cost, one_local, one_remote, edge in sorted(pair_edges, key=lambda x: x[0]):
+        amount = network.flow_on(edge)
+        if amount >= MIN_REBALANCE_AMOUNT:
+            planned.append((one_local, one_remote, amount))
+    return planned
+
+
+def get_own_pubkey():
+    try:
+        data = lnd.get_info()
+    except lnd_client.LndError as err:
+        print("Failed to get node info", err)
+        exit(1)
+    if "identity_pubkey" not in data:
+        print("No node info found")
         exit(2)
-    return invoice_string
+    return data["identity_pubkey"]
+
+
+def probe_pair(one_local, one_remote, amount):
+    # Ask lnd for a circular route out through one_local and back in through one_remote.
+    # Nothing is paid, so a pair without a route costs milliseconds instead of a failed payinvoice.
+    try:
+        data = lnd.query_routes(own_pubkey, amount, fee_limit=fee_limit_for(one_local, one_remote, amount),
+                                outgoing_chan_id=one_local.channel_id, last_hop=one_remote.remote_pubkey)
+    except lnd_client.LndError as err:
+        if DEBUG_FAILURE:
+            print("+" * 20)
+            print(err)
+            print("+" * 20)
+        pair_history.record(one_local.channel_id, one_remote.channel_id, amount, False)
+        return None
+    if len(data.get("routes", [])) == 0:
+        pair_history.record(one_local.channel_id, one_remote.channel_id, amount, False)
+        return None
+    probe = RouteProbe(data["routes"][0])
+    if PROBE_WITH_PAYMENT and not probe_route_liquidity(probe):
+        pair_history.record(one_local.channel_id, one_remote.channel_id, amount, False)
+        return None
+    return probe
 
 
-def count_channels_with_capacity(channels, amt):
-    matching = 0
-    for check_channel in channels:
-        remote_capacity = int(check_channel.remote_balance / 2)
-        if remote_capacity >= amt:
-            matching += 1
-    return matching
+def probe_route_liquidity(probe):
+    # Send the route an HTLC for a hash nobody knows. If it makes it all the way
+    # back to us we reject it as unknown, which proves every hop had the liquidity.
+    probe_hash = os.urandom(32).hex()
+    try:
+        attempt = lnd.send_to_route(probe_hash, probe.route)
+    except lnd_client.LndError as err:
+        if DEBUG_FAILURE:
+            print("Probe payment failed", err)
+        return False
+    failure = attempt.get("failure") or {}
+    return failure.get("code") == "INCORRECT_OR_UNKNOWN_PAYMENT_DETAILS"
+
+
+def probe_planned_jobs(planned_jobs):
+    # Returns the jobs with a route, cheapest route fee per sat first
+    with ThreadPoolExecutor(max_workers=PROBE_CONCURRENCY) as probe_executor:
+        probes = list(probe_executor.map(lambda job: probe_pair(job[0], job[1], job[2]), planned_jobs))
+    feasible_queue = []
+    for job_index, (job, probe) in enumerate(zip(planned_jobs, probes)):
+        if probe is None:
+            print("  No route found for", job[0].channel_id, "->", job[1].channel_id)
+            continue
+        fee_ppm = probe.total_fees_msat * 1000 / job[2]
+        heapq.heappush(feasible_queue, (fee_ppm, job_index, job))
+    feasible_jobs = []
+    while len(feasible_queue) > 0:
+        feasible_jobs.append(heapq.heappop(feasible_queue)[2])
+    return feasible_jobs
 
 
-def get_lncli():
-    which_lncli = Commandline("which lncli")
-    which_lncli.run()
-    lncli_alias = "lncli"
-    if len(which_lncli.error) > 0:
-        print("Failed to determine where lncli is located", which_lncli.error)
+def pay_pair_adaptively(one_local, one_remote, amount, ledger, wait=False, probed=False):
+    # Pays up to amount from one_local out through one_remote, in pieces if it has to:
+    # smaller after a liquidity failure, bigger again after a success
+    largest_success, smallest_failure = pair_history.amount_bounds(one_local.channel_id, one_remote.channel_id)
+    search = AmountSearch(amount, largest_success, smallest_failure)
+    remaining = amount
+    paid_total = 0
+    for attempt in range(MAX_ATTEMPTS_PER_PAIR):
+        try_amount = min(search.amount, remaining)
+        if try_amount < MIN_REBALANCE_AMOUNT:
+            break
+        fee_limit = fee_limit_for(one_local, one_remote, try_amount)
+        if fee_limit < 1:
+            # not even one sat of fees would be earned back, don't spend time looking for a route
+            if attempt == 0:
+                print("  Skipping", one_remote.channel_id, "- not profitable at", try_amount, "sats")
+            break
+        if not ledger.reserve(one_local, one_remote, try_amount, wait=wait):
+            if attempt == 0:
+                print("  Not enough room left for", try_amount, "sats through", one_remote.channel_id)
+            break
+        if attempt > 0:
+            print("  Trying", try_amount, "sats through", one_remote.channel_id)
+        if PROBE_ROUTES and (attempt > 0 or not probed) and \
+                probe_pair(one_local, one_remote, try_amount) is None:
+            print("  No route found for", one_remote.channel_id)
+            ledger.release(one_local, one_remote, try_amount, 0)
+            search.failed(try_amount)
+            continue
+        the_invoice = None
+        if not USE_KEYSEND:
+            the_invoice = create_invoice(try_amount)
+        result = pay_invoice_for_sats_to_remote(the_invoice, try_amount, one_remote, one_local.channel_id,
+                                                fee_limit)
+        ledger.release(one_local, one_remote, try_amount, result.amount_paid)
+        if result.amount_paid > 0:
+            paid_total += result.amount_paid
+            remaining -= result.amount_paid
+            search.succeeded(try_amount)
+        elif result.liquidity_failure():
+            search.failed(try_amount)
+        else:
+            break
+    return paid_total
+
+
+def run_planned_job(one_local, one_remote, amount, ledger):
+    print("Trying to balance", one_local.channel_id, "through", one_remote.channel_id, "by moving", amount)
+    # waits for the last hop if another job is using it
+    return pay_pair_adaptively(one_local, one_remote, amount, ledger, wait=True, probed=PROBE_ROUTES)
+
+
+def balance_outgoing_channel(one_local, payment_amount, ledger, engine):
+    # Runs on a worker thread: each outgoing channel is handled by one job,
+    # and the engine hands every inbound channel to one job at a time
+    outgoing_chan_id = one_local.channel_id
+
+    available = engine.count_with_capacity(payment_amount)
+    print("Trying to balance", outgoing_chan_id, "by moving", payment_amount)
+    print("  There are", available, "channels with enough inbound-capacity")
+
+    remaining = payment_amount
+    # When the mostly-inbound channels are done, can we skim a little off of our balanced channels?
+    for kind in ["inbound", "skim"]:
+        tried = set()
+        while remaining >= MIN_REBALANCE_AMOUNT:
+            one_remote = engine.take(kind, tried, MIN_REBALANCE_AMOUNT)
+            if one_remote is None:
+                break
+            tried.add(one_remote.channel_id)
+            room = int(movement_capacity(one_remote))
+            start_amount = pair_history.suggested_amount(outgoing_chan_id, one_remote.channel_id,
+                                                         min(remaining, room), MIN_REBALANCE_AMOUNT)
+            if start_amount == 0:
+                if kind == "inbound":
+                    print("  Skipping", one_remote.channel_id, "- it failed recently at this amount")
+                engine.give_back(kind, one_remote)
+                continue
+            remaining -= pay_pair_adaptively(one_local, one_remote, start_amount, ledger)
+            engine.give_back(kind, one_remote)
+    print("-" * 20)
+
+
+def create_invoice(amt):
+    try:
+        invoice_json = lnd.add_invoice(amt, "Automatic rebalancing", 600)
+    except lnd_client.LndError as err:
+        print("Failed to run invoice creation", err)
         exit(1)
-    elif len(which_lncli.output) > 0:
-        # this should work on non-umbrel nodes (but I haven't tested)
-        lncli_alias = "lncli"
-    else:
-        # docker is for running on the umbrel
-        lncli_alias = "docker exec -it lnd lncli"
+    invoice_string = invoice_json.get("payment_request", "")
 
-    if DEBUG:
-        print("Using {lncli}".format(lncli=lncli_alias))
-    return lncli_alias
+    if len(invoice_string) == 0:
+        print("Failed to create an invoice")
+        exit(2)
+    return invoice_string
 
 
 def get_channels():
-    listchannels = '{lncli} listchannels --active_only --public_only'.format(lncli=lncli_cmd)
-    if DEBUG:
-        print(listchannels)
-        print("-" * 15)
-    data = {}
-    list_channels = Commandline(listchannels)
-    list_channels.run()
-    if len(list_channels.error) > 0:
-        print("Failed to get channels", list_channels.error)
+    try:
+        data = lnd.list_channels()
+    except lnd_client.LndError as err:
+        print("Failed to get channels", err)
         exit(1)
-    elif len(list_channels.output) > 0:
-        data = json.loads(list_channels.output)
-    else:
+    if "channels" not in data:
         print("No channels found")
         exit(2)
 
@@ -185,121 +865,233 @@ def get_channels():
     for channel_record in the_channels:
         result_array.append(Channel(channel_record))
 
+    if PROFITABLE_FEE_LIMITS:
+        update_channel_fees(result_array)
     return result_array
 
 
-lncli_cmd = get_lncli()
-if DEBUG:
-    print("Using {lncli}".format(lncli=lncli_cmd))
-all_channels = get_channels()
+def update_channel_fees(channel_list):
+    try:
+        data = lnd.fee_report()
+    except lnd_client.LndError as err:
+        print("Failed to get channel fees", err)
+        exit(1)
+    if "channel_fees" not in data:
+        print("No channels found")
+        exit(2)
+
+    channel_point_map = {}
+    for one in channel_list:
+        channel_point_map[one.channel_point] = one
+
+    channel_fees = data["channel_fees"]
+    for fee_record in channel_fees:
+        channel_point = fee_record["channel_point"]
+        if channel_point in channel_point_map:
+            one = channel_point_map[channel_point]
+            one.base_fee_msat = int(fee_record["base_fee_msat"])
+            one.ppm_fee = int(fee_record["fee_per_mil"])
+
 
-balanced_channels = []
-unbalanced_channels = []
-for one in all_channels:
-    if DEBUG:
-        print(one.remote_pubkey, one.remote_balance, one.local_balance, one.balance_ratio(), one.out_of_balance())
-    if one.out_of_balance() is True:
-        unbalanced_channels.append(one)
+def get_payment_amount(one_local, move_less, move_specific):
+    if move_less is True:
+        payment_amount = int((one_local.local_balance + one_local.remote_balance) / 4)
+        if 0 < move_specific < payment_amount:
+            payment_amount = move_specific
     else:
-        balanced_channels.append(one)
+        payment_amount = int((one_local.local_balance + one_local.remote_balance) / 2)
+        if one_local.remote_balance < payment_amount:
+            payment_amount -= one_local.remote_balance
+    return payment_amount
 
-if len(balanced_channels) > 0:
-    print("You have", len(balanced_channels), "that are balanced-enough")
 
-if len(unbalanced_channels) > 0:
+def split_channels(channels):
+    balanced_channels = []
     mostly_local = []
     mostly_remote = []
-    for one_channel in unbalanced_channels:
-        if one_channel.remote_balance > one_channel.local_balance:
-            mostly_remote.append(one_channel)
-        else:
-            mostly_local.append(one_channel)
-
-    print("You have", len(mostly_remote), "channels with mostly inbound capacity")
-    print("You have", len(mostly_local), "channels with mostly outbound capacity")
-    print("We are going to try find routes to balance these channels.")
-
-    user_input = input('How many sats can we spend for each transaction? ({fees} sats default) : '.format(
-        fees=FEE_PER_REBALANCE))
-    if len(user_input) > 0:
-        FEE_PER_REBALANCE = int(user_input)
-    print("Using {fees} sats as our maximum fee".format(fees=FEE_PER_REBALANCE))
-    print("")
-
-    move_specific = 0
-    user_input = input('Do you want to try moving a fixed amount per channel? Type y / n : ')
-    print("")
-    if user_input.startswith("y") or user_input.startswith("Y"):
-        user_input = input('OK, great. How many sats would you like to move (at most)? (250000)) : ')
-        if len(user_input) == 0:
-            user_input = 250000
-        move_less = True
-        move_specific = int(user_input)
-        if move_specific <= 0:
-            move_specific = 250000
-    else:
-        user_input = input('Do you want to try moving 25% of the channel capacity? Type y / n : ')
-        print("")
-        if user_input.startswith("y") or user_input.startswith("Y"):
-            move_less = True
+    for one in channels:
+        if DEBUG:
+            print(one.remote_pubkey, one.remote_balance, one.local_balance, one.balance_ratio(), one.out_of_balance())
+        if one.out_of_balance() is False:
+            balanced_channels.append(one)
+        elif one.remote_balance > one.local_balance:
+            mostly_remote.append(one)
         else:
-            move_less = False
+            mostly_local.append(one)
+    return mostly_local, mostly_remote, balanced_channels
 
+
+def rebalance_channels(mostly_local, mostly_remote, balanced_channels, move_less, move_specific):
     if len(mostly_local) > 0 and len(mostly_remote) > 0:
         # we have at least one pair we can try to rebalance
         mostly_local.sort(key=lambda x: x.remote_balance, reverse=False)
         mostly_remote.sort(key=lambda x: x.remote_balance, reverse=True)
         # lncli addinvoice --expiry 60 --memo "Automatic rebalancing" --amt <>
         # lncli payinvoice --fee_limit 20 --allow_self_payment --outgoing_chan_id <> --last_hop <> <invoice>
+        rebalance_jobs = []
         for one_local in mostly_local:
-            if move_less is True:
-                payment_amount = int((one_local.local_balance + one_local.remote_balance) / 4)
-                if 0 < move_specific < payment_amount:
-                    payment_amount = move_specific
-            else:
-                payment_amount = int((one_local.local_balance + one_local.remote_balance) / 2)
-                if one_local.remote_balance < payment_amount:
-                    payment_amount -= one_local.remote_balance
+            payment_amount = get_payment_amount(one_local, move_less, move_specific)
 
-            outgoing_chan_id = one_local.channel_id
             if payment_amount <= 0:
                 print("-------> ", one_local.remote_pubkey,
                       "Remote", one_local.remote_balance,
                       "Local", one_local.local_balance,
                       "Target move", payment_amount)
                 continue
+            rebalance_jobs.append((one_local, payment_amount))
 
-            the_invoice = create_invoice(payment_amount)
-
-            available = count_channels_with_capacity(mostly_remote, payment_amount)
-            print("Trying to balance", outgoing_chan_id, "by moving", payment_amount)
-            print("  There are", available, "channels with enough inbound-capacity")
-
-            used_remote_channel = None
-            for one_remote in mostly_remote:
-                paid_total = pay_invoice_for_sats_to_remote(the_invoice, payment_amount, one_remote)
-                if paid_total > 0:
-                    used_remote_channel = one_remote
-                    one_remote.remote_balance -= paid_total
-                    one_remote.local_balance += paid_total
-                    one_local.local_balance -= paid_total
-                    one_local.remote_balance += paid_total
-                    break
+        ledger = BalanceLedger()
+        if USE_FLOW_PLANNER:
+            # balanced channels that are 60% + remote can take a little too
+            inbound_channels = mostly_remote + [x for x in balanced_channels if x.balance_ratio() > 0.6]
+            planned_jobs = plan_rebalance_jobs(rebalance_jobs, inbound_channels)
+            planned_total = sum(x[2] for x in planned_jobs)
+            print("Planned", len(planned_jobs), "payments moving", planned_total, "sats")
+            if PROBE_ROUTES:
+                planned_jobs = probe_planned_jobs(planned_jobs)
+                planned_total = sum(x[2] for x in planned_jobs)
+                print("Found routes for", len(planned_jobs), "payments moving", planned_total, "sats")
+            print("-" * 20)
+            with ThreadPoolExecutor(max_workers=MAX_IN_FLIGHT_PAYMENTS) as rebalance_executor:
+                paid_amounts = list(rebalance_executor.map(lambda job: run_planned_job(job[0], job[1], job[2], ledger),
+                                                           planned_jobs))
+            print("-" * 20)
+            print("Moved", sum(paid_amounts), "of", planned_total, "planned sats")
+            print_attempt_times()
+        else:
+            # balanced channels that are 60% + remote can take a little too
+            engine = MatchingEngine(mostly_remote, [x for x in balanced_channels if x.balance_ratio() > 0.6])
+            with ThreadPoolExecutor(max_workers=MAX_IN_FLIGHT_PAYMENTS) as rebalance_executor:
+                # list() waits for every job, and re-raises anything that went wrong in one
+                list(rebalance_executor.map(lambda job: balance_outgoing_channel(job[0], job[1], ledger, engine),
+                                            rebalance_jobs))
+            print_attempt_times()
+
+
+def print_attempt_times():
+    summary = attempt_times.summary()
+    if summary is not None:
+        print(summary)
+
+
+def rebalance_crossed_channels(channels, crossed_channels):
+    # Daemon mode: only channels that just went out of balance get a round,
+    # matched against every channel on the other side
+    mostly_local, mostly_remote, balanced_channels = split_channels(channels)
+    crossed_local = [x for x in crossed_channels if x in mostly_local]
+    crossed_remote = [x for x in crossed_channels if x in mostly_remote]
+    if len(crossed_local) == 0 and len(crossed_remote) == 0:
+        return
+    for one in crossed_local + crossed_remote:
+        print(one.channel_id, "is now {:0.0f}% remote".format(one.balance_ratio() * 100))
+    sources = list(crossed_local)
+    sinks = list(crossed_remote)
+    if len(crossed_remote) > 0:
+        sources += [x for x in mostly_local if x not in crossed_local]
+    if len(crossed_local) > 0:
+        sinks += [x for x in mostly_remote if x not in crossed_remote]
+    rebalance_channels(sources, sinks, balanced_channels, False, 0)
+
+
+# set by setup()
+lnd = None
+own_pubkey = None
+pair_history = None
+attempt_times = None
+
+
+def setup(snapshot_ttl=None):
+    # Connects to lnd and loads the pair history. main() starts with it, a program that
+    # imports this file calls it before rebalance_all() or rebalance_channels().
+    global lnd, own_pubkey, pair_history, attempt_times
+    lnd = lnd_client.connect(snapshot_ttl)
+    if (PROBE_ROUTES or USE_KEYSEND) and own_pubkey is None:
+        own_pubkey = get_own_pubkey()
+    if pair_history is not None:
+        pair_history.close()
+    pair_history = PairHistory(PAIR_HISTORY_HALF_LIFE)
+    pair_history.load(PAIR_HISTORY_PATH)
+    attempt_times = AttemptTimes()
+
+
+def rebalance_all(move_less=False, move_specific=0):
+    # One round over every channel with the settings at the top of this file, without asking anything
+    mostly_local, mostly_remote, balanced_channels = split_channels(get_channels())
+    rebalance_channels(mostly_local, mostly_remote, balanced_channels, move_less, move_specific)
+
+
+def main(argv=None):
+    global FEE_PER_REBALANCE, MAX_IN_FLIGHT_PAYMENTS
+    parser = argparse.ArgumentParser(
+        description="Move sats from mostly-outbound channels to mostly-inbound channels.")
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep running, and rebalance channels as soon as they go out of balance "
+                             "(uses the defaults instead of asking)")
+    args = parser.parse_args(argv)
+
+    # the daemon reacts to balance changes, so it always asks lnd instead of using the snapshot
+    snapshot_ttl = None
+    if args.daemon:
+        snapshot_ttl = 0
+    setup(snapshot_ttl)
 
-            if used_remote_channel is not None and (used_remote_channel.balance_ratio() <= 0.35):
-                print("  ", used_remote_channel.channel_id, "is now balanced enough.",
-                      "Remote ratio", used_remote_channel.balance_ratio())
-                mostly_remote.remove(used_remote_channel)
+    if args.daemon:
+        import channel_events
+        if PROFITABLE_FEE_LIMITS:
+            print("Using the fees of each pair of channels as our maximum fee")
+        else:
+            print("Using {fees} sats as our maximum fee".format(fees=FEE_PER_REBALANCE))
+        channel_events.watch_channels(get_channels, rebalance_crossed_channels)
+        return
+
+    all_channels = get_channels()
+    mostly_local, mostly_remote, balanced_channels = split_channels(all_channels)
+
+    if len(balanced_channels) > 0:
+        print("You have", len(balanced_channels), "that are balanced-enough")
+
+    if len(mostly_local) > 0 or len(mostly_remote) > 0:
+        print("You have", len(mostly_remote), "channels with mostly inbound capacity")
+        print("You have", len(mostly_local), "channels with mostly outbound capacity")
+        print("We are going to try find routes to balance these channels.")
+
+        if PROFITABLE_FEE_LIMITS:
+            print("Using the fees of each pair of channels as our maximum fee")
+        else:
+            user_input = input('How many sats can we spend for each transaction? ({fees} sats default) : '.format(
+                fees=FEE_PER_REBALANCE))
+            if len(user_input) > 0:
+                FEE_PER_REBALANCE = int(user_input)
+            print("Using {fees} sats as our maximum fee".format(fees=FEE_PER_REBALANCE))
+        print("")
+
+        move_specific = 0
+        user_input = input('Do you want to try moving a fixed amount per channel? Type y / n : ')
+        print("")
+        if user_input.startswith("y") or user_input.startswith("Y"):
+            user_input = input('OK, great. How many sats would you like to move (at most)? (250000)) : ')
+            if len(user_input) == 0:
+                user_input = 250000
+            move_less = True
+            move_specific = int(user_input)
+            if move_specific <= 0:
+                move_specific = 250000
+        else:
+            user_input = input('Do you want to try moving 25% of the channel capacity? Type y / n : ')
+            print("")
+            if user_input.startswith("y") or user_input.startswith("Y"):
+                move_less = True
             else:
-                # Can se skim a little off of our balanced channels?
-                for one_balanced in balanced_channels:
-                    # 60% + is remote
-                    if one_balanced.balance_ratio() > 0.6:
-                        paid_total = pay_invoice_for_sats_to_remote(the_invoice, payment_amount, one_balanced)
-                        if paid_total > 0:
-                            one_balanced.remote_balance -= paid_total
-                            one_balanced.local_balance += paid_total
-                            one_local.local_balance -= paid_total
-                            one_local.remote_balance += paid_total
-                            break
-            print("-" * 20)
+                move_less = False
+
+        user_input = input('How many rebalances should we try at once? ({count} default) : '.format(
+            count=MAX_IN_FLIGHT_PAYMENTS))
+        if len(user_input) > 0 and int(user_input) > 0:
+            MAX_IN_FLIGHT_PAYMENTS = int(user_input)
+        print("")
+
+        rebalance_channels(mostly_local, mostly_remote, balanced_channels, move_less, move_specific)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,14 @@
-import json
-import shlex
-import subprocess
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import lnd_client
 
 DEBUG = False
 DEBUG_FAILURE = False
 DEFAULT_BASE_FEE = 0
 DEFAULT_BASE_PPM = 1000
 DEFAULT_TIMELOCK = 40
+UPDATE_CONCURRENCY = 8  # Fee updates sent to lnd at the same time
 
 
 class Channel:
@@ -37,70 +39,13 @@ class Channel:
         return False
 
 
-class Commandline:
-    def __init__(self, command):
-        self.command_args = shlex.split(command)
-        self.output = ""
-        self.error = ""
-        self.exit_code = 0
-
-    def run(self):
-
-        try:
-            stdout = subprocess.check_output(self.command_args)
-            stderr = None
-        except subprocess.CalledProcessError as err:
-            # print("+" * 20)
-            # print("Command failure:", err.returncode)
-            # print(err.output.decode("utf-8"))
-            # print("+" * 20)
-            stdout = None
-            stderr = err.output
-            self.exit_code = err.returncode
-
-        if stdout is None:
-            self.output = ""
-        else:
-            self.output = stdout.decode("utf-8")
-        if stderr is None:
-            self.error = ""
-        else:
-            self.error = stderr.decode("utf-8")
-
-
-def get_lncli():
-    which_lncli = Commandline("which lncli")
-    which_lncli.run()
-    lncli_alias = "lncli"
-    if len(which_lncli.error) > 0:
-        print("Failed to determine where lncli is located", which_lncli.error)
-        exit(1)
-    elif len(which_lncli.output) > 0:
-        # this should work on non-umbrel nodes (but I haven't tested)
-        lncli_alias = "lncli"
-    else:
-        # docker is for running on the umbrel
-        lncli_alias = "docker exec -it lnd lncli"
-
-    if DEBUG:
-        print("Using {lncli}".format(lncli=lncli_alias))
-    return lncli_alias
-
-
 def get_channels():
-    listchannels = '{lncli} listchannels --active_only --public_only'.format(lncli=lncli_cmd)
-    if DEBUG:
-        print(listchannels)
-        print("-" * 15)
-    data = {}
-    list_channels = Commandline(listchannels)
-    list_channels.run()
-    if len(list_channels.error) > 0:
-        print("Failed to get channels", list_channels.error)
+    try:
+        data = lnd.list_channels()
+    except lnd_client.LndError as err:
+        print("Failed to get channels", err)
         exit(1)
-    elif len(list_channels.output) > 0:
-        data = json.loads(list_channels.output)
-    else:
+    if "channels" not in data:
         print("No channels found")
         exit(2)
 
@@ -115,19 +60,12 @@ def get_channels():
 
 
 def update_channel_fees(channel_list):
-    feereport = '{lncli} feereport'.format(lncli=lncli_cmd)
-    if DEBUG:
-        print(feereport)
-        print("-" * 15)
-    data = {}
-    fee_cmd = Commandline(feereport)
-    fee_cmd.run()
-    if len(fee_cmd.error) > 0:
-        print("Failed to get channel fees", fee_cmd.error)
+    try:
+        data = lnd.fee_report()
+    except lnd_client.LndError as err:
+        print("Failed to get channel fees", err)
         exit(1)
-    elif len(fee_cmd.output) > 0:
-        data = json.loads(fee_cmd.output)
-    else:
+    if "channel_fees" not in data:
         print("No channels found")
         exit(2)
 
@@ -144,61 +82,32 @@ def update_channel_fees(channel_list):
             one.ppm_fee = int(fee_record["fee_per_mil"])
 
 
-lncli_cmd = get_lncli()
-all_channels = get_channels()
-
-balanced_channels = []
-unbalanced_channels = []
-mostly_local = []
-mostly_remote = []
-for one_channel in all_channels:
-    if one_channel.out_of_balance() is True:
-        unbalanced_channels.append(one_channel)
-        if one_channel.remote_balance > one_channel.local_balance:
-            mostly_remote.append(one_channel)
-        else:
-            mostly_local.append(one_channel)
-    else:
-        balanced_channels.append(one_channel)
-
-print("You have", len(balanced_channels), "channels that are mostly balanced")
-print("You have", len(mostly_remote), "channels with mostly inbound capacity")
-print("You have", len(mostly_local), "channels with mostly outbound capacity")
-print("We are going to:")
-print("   -- raise fees on mostly-outbound channels")
-print("   -- lower fees on mostly-inbound channels")
-print("   -- reset fees on mostly-balanced channels")
-
-user_base = DEFAULT_BASE_FEE
-user_ppm = DEFAULT_BASE_PPM
-user_timelock = DEFAULT_TIMELOCK
-user_input = input('What would you like your base fee to be? [format: base,ppm,timelock]'
-                   ' ({base},{ppm},{timelock} sats default) : '.format(
-    base=user_base, ppm=user_ppm, timelock=user_timelock))
-if len(user_input) > 0:
-    two_words = user_input.split(',')
-    if len(two_words) == 1:
-        user_base = int(two_words[0])
-    elif len(two_words) == 2:
-        user_base = int(two_words[0])
-        user_ppm = int(two_words[1])
-    elif len(two_words) == 3:
-        user_base = int(two_words[0])
-        user_ppm = int(two_words[1])
-        user_timelock = int(two_words[2])
-
-if user_base <= 0:
-    user_base = 0
-if user_ppm <= 0:
-    user_ppm = 0
-if user_timelock <= 0:
+def parse_fee_input(user_input):
+    user_base = DEFAULT_BASE_FEE
+    user_ppm = DEFAULT_BASE_PPM
     user_timelock = DEFAULT_TIMELOCK
-
-print("Using {base},{ppm} sats as our base fee, "
-      "with {timelock} as the timelock.".format(
-    base=user_base, ppm=user_ppm, timelock=user_timelock))
-
-for unbalanced in unbalanced_channels:
+    if len(user_input) > 0:
+        two_words = user_input.split(',')
+        if len(two_words) == 1:
+            user_base = int(two_words[0])
+        elif len(two_words) == 2:
+            user_base = int(two_words[0])
+            user_ppm = int(two_words[1])
+        elif len(two_words) == 3:
+            user_base = int(two_words[0])
+            user_ppm = int(two_words[1])
+            user_timelock = int(two_words[2])
+
+    if user_base <= 0:
+        user_base = 0
+    if user_ppm <= 0:
+        user_ppm = 0
+    if user_timelock <= 0:
+        user_timelock = DEFAULT_TIMELOCK
+    return user_base, user_ppm, user_timelock
+
+
+def adjusted_fees(unbalanced, user_base, user_ppm):
     score = unbalanced.balance_ratio()
     if score > 0.50:
         # mostly remote
@@ -234,46 +143,134 @@ for unbalanced in unbalanced_channels:
     else:
         adjusted_base = int(user_base)
         adjusted_ppm = int(user_ppm)
+    return adjusted_base, adjusted_ppm
 
-    print(unbalanced.channel_id, "out of balance", unbalanced.local_balance, unbalanced.remote_balance)
-    print("   Channel balance is {:0.0f}% remote".format(unbalanced.balance_ratio() * 100))
-    if unbalanced.base_fee_msat != adjusted_base or unbalanced.ppm_fee != adjusted_ppm:
-        print("   Current fees", unbalanced.base_fee_msat, unbalanced.ppm_fee)
-        print("   Updating fees to", adjusted_base, adjusted_ppm)
-        udpatefee = '{lncli} updatechanpolicy --base_fee_msat {base_fee} ' \
-                    '--fee_rate {ppm_fee} --time_lock_delta {timelock} --chan_point {channel_point}'.format(
-            lncli=lncli_cmd, base_fee=adjusted_base, ppm_fee=(float(adjusted_ppm) / 1000000),
-            channel_point=unbalanced.channel_point, timelock=user_timelock)
-        if DEBUG:
-            print(udpatefee)
-            print("-" * 15)
-        update_fee_command = Commandline(udpatefee)
-        update_fee_command.run()
-        if len(update_fee_command.error) > 0:
-            print("Failed to update fee", update_fee_command.error)
-            exit(1)
-    else:
-        print("   Keeping fees the same", unbalanced.base_fee_msat, unbalanced.ppm_fee)
-    print("-" * 20)
-
-for balanced in balanced_channels:
-    print(balanced.channel_id, "is mostly balanced", balanced.local_balance, balanced.remote_balance)
-    print("   Channel balance is {:0.0f}% remote".format(balanced.balance_ratio() * 100))
-    if balanced.base_fee_msat != user_base:
-        print("   Current fees", balanced.base_fee_msat, balanced.ppm_fee)
-        print("   Updating fees to", user_base, user_ppm)
-        udpatefee = '{lncli} updatechanpolicy --base_fee_msat {base_fee} ' \
-                    '--fee_rate {ppm_fee} --time_lock_delta {timelock} --chan_point {channel_point}'.format(
-            lncli=lncli_cmd, base_fee=user_base, ppm_fee=(float(user_ppm) / 1000000),
-            channel_point=balanced.channel_point, timelock=user_timelock)
-        if DEBUG:
-            print(udpatefee)
-            print("-" * 15)
-        update_fee_command = Commandline(udpatefee)
-        update_fee_command.run()
-        if len(update_fee_command.error) > 0:
-            print("Failed to update fee", update_fee_command.error)
-            exit(1)
-    else:
-        print("   Keeping fees the same", balanced.base_fee_msat, balanced.ppm_fee)
-    print("-" * 20)
+
+def update_fees(one_channel, base_fee, ppm_fee, timelock):
+    try:
+        lnd.update_chan_policy(one_channel.channel_point, base_fee, ppm_fee, timelock)
+    except lnd_client.LndError as err:
+        print("Failed to update fee", err)
+        exit(1)
+    one_channel.base_fee_msat = base_fee
+    one_channel.ppm_fee = ppm_fee
+
+
+def update_crossed_channel_fees(channels, crossed_channels, user_base, user_ppm, user_timelock):
+    # Daemon mode: only channels that crossed the 0.3 / 0.7 thresholds get new fees
+    for one_channel in crossed_channels:
+        print(one_channel.channel_id, "is now {:0.0f}% remote".format(one_channel.balance_ratio() * 100))
+        if one_channel.out_of_balance():
+            base_fee, ppm_fee = adjusted_fees(one_channel, user_base, user_ppm)
+        else:
+            base_fee, ppm_fee = user_base, user_ppm
+        if one_channel.base_fee_msat != base_fee or one_channel.ppm_fee != ppm_fee:
+            print("   Current fees", one_channel.base_fee_msat, one_channel.ppm_fee)
+            print("   Updating fees to", base_fee, ppm_fee)
+            update_fees(one_channel, base_fee, ppm_fee, user_timelock)
+        else:
+            print("   Keeping fees the same", one_channel.base_fee_msat, one_channel.ppm_fee)
+        print("-" * 20)
+
+
+# set by main()
+lnd = None
+
+
+def main(argv=None):
+    global lnd
+    parser = argparse.ArgumentParser(description="Set channel fees based upon channel remote/local balance.")
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep running, and update a channel's fees as soon as it crosses "
+                             "the 30%% / 70%% balance thresholds")
+    parser.add_argument("--fees", default="",
+                        help="base,ppm,timelock to use instead of asking (default {base},{ppm},{timelock})".format(
+                            base=DEFAULT_BASE_FEE, ppm=DEFAULT_BASE_PPM, timelock=DEFAULT_TIMELOCK))
+    args = parser.parse_args(argv)
+
+    # the daemon reacts to balance changes, so it always asks lnd instead of using the snapshot
+    snapshot_ttl = None
+    if args.daemon:
+        snapshot_ttl = 0
+    lnd = lnd_client.connect(snapshot_ttl)
+
+    if args.daemon:
+        import channel_events
+        user_base, user_ppm, user_timelock = parse_fee_input(args.fees)
+        print("Using {base},{ppm} sats as our base fee, "
+              "with {timelock} as the timelock.".format(
+            base=user_base, ppm=user_ppm, timelock=user_timelock))
+        channel_events.watch_channels(get_channels, lambda channels, crossed: update_crossed_channel_fees(
+            channels, crossed, user_base, user_ppm, user_timelock))
+        return
+
+    all_channels = get_channels()
+
+    balanced_channels = []
+    unbalanced_channels = []
+    mostly_local = []
+    mostly_remote = []
+    for one_channel in all_channels:
+        if one_channel.out_of_balance() is True:
+            unbalanced_channels.append(one_channel)
+            if one_channel.remote_balance > one_channel.local_balance:
+                mostly_remote.append(one_channel)
+            else:
+                mostly_local.append(one_channel)
+        else:
+            balanced_channels.append(one_channel)
+
+    print("You have", len(balanced_channels), "channels that are mostly balanced")
+    print("You have", len(mostly_remote), "channels with mostly inbound capacity")
+    print("You have", len(mostly_local), "channels with mostly outbound capacity")
+    print("We are going to:")
+    print("   -- raise fees on mostly-outbound channels")
+    print("   -- lower fees on mostly-inbound channels")
+    print("   -- reset fees on mostly-balanced channels")
+
+    user_input = args.fees
+    if len(user_input) == 0:
+        user_input = input('What would you like your base fee to be? [format: base,ppm,timelock]'
+                           ' ({base},{ppm},{timelock} sats default) : '.format(
+            base=DEFAULT_BASE_FEE, ppm=DEFAULT_BASE_PPM, timelock=DEFAULT_TIMELOCK))
+    user_base, user_ppm, user_timelock = parse_fee_input(user_input)
+
+    print("Using {base},{ppm} sats as our base fee, "
+          "with {timelock} as the timelock.".format(
+        base=user_base, ppm=user_ppm, timelock=user_timelock))
+
+    # The updates go out while the rest is printed, any failure stops the script at the end
+    update_executor = ThreadPoolExecutor(max_workers=UPDATE_CONCURRENCY)
+    fee_updates = []
+    for unbalanced in unbalanced_channels:
+        adjusted_base, adjusted_ppm = adjusted_fees(unbalanced, user_base, user_ppm)
+
+        print(unbalanced.channel_id, "out of balance", unbalanced.local_balance, unbalanced.remote_balance)
+        print("   Channel balance is {:0.0f}% remote".format(unbalanced.balance_ratio() * 100))
+        if unbalanced.base_fee_msat != adjusted_base or unbalanced.ppm_fee != adjusted_ppm:
+            print("   Current fees", unbalanced.base_fee_msat, unbalanced.ppm_fee)
+            print("   Updating fees to", adjusted_base, adjusted_ppm)
+            fee_updates.append(update_executor.submit(update_fees, unbalanced, adjusted_base, adjusted_ppm,
+                                                      user_timelock))
+        else:
+            print("   Keeping fees the same", unbalanced.base_fee_msat, unbalanced.ppm_fee)
+        print("-" * 20)
+
+    for balanced in balanced_channels:
+        print(balanced.channel_id, "is mostly balanced", balanced.local_balance, balanced.remote_balance)
+        print("   Channel balance is {:0.0f}% remote".format(balanced.balance_ratio() * 100))
+        if balanced.base_fee_msat != user_base:
+            print("   Current fees", balanced.base_fee_msat, balanced.ppm_fee)
+            print("   Updating fees to", user_base, user_ppm)
+            fee_updates.append(update_executor.submit(update_fees, balanced, user_base, user_ppm, user_timelock))
+        else:
+            print("   Keeping fees the same", balanced.base_fee_msat, balanced.ppm_fee)
+        print("-" * 20)
+
+    for one_update in fee_updates:
+        one_update.result()
+    update_executor.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,28 @@
+import argparse
+import codecs
+import gzip
+import heapq
 import json
-import shlex
-import subprocess
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import lnd_client
+
+try:
+    import numpy
+    from scipy import sparse
+except ImportError:
+    # Scoring falls back to plain python, which is fine for a few dozen candidates
+    numpy = None
+    sparse = None
 
 DEBUG = False
 MINIMUM_NODE_DISTANCE = 7
@@ -8,6 +30,52 @@ MAX_NODE_DISTANCE = 4
 MIN_CHANNEL_CAPACITY = 500000
 MINIMUM_CHANNEL_COUNT = 5
 MINIMUM_BTC_COUNT = 0.10
+# Load the whole network with one describegraph call instead of one getnodeinfo per node
+USE_GRAPH_SNAPSHOT = True
+# With the graph snapshot, only the best candidates are double-checked with queryroutes
+CONFIRM_TOP_N = 5
+# Without the graph snapshot, this many getnodeinfo / queryroutes calls run at once
+CRAWL_CONCURRENCY = 8
+LNCLI_TIMEOUT = 60  # In seconds, for each question to lnd
+# Candidates scored together in one sparse matrix pass (needs numpy & scipy)
+SCORE_BATCH_SIZE = 64
+# The graph snapshot is saved here and reused until it is older than GRAPH_CACHE_TTL
+GRAPH_CACHE_PATH = "rebalance_network.graph"
+GRAPH_CACHE_TTL = 6 * 60 * 60  # In seconds, 0 turns the cache off
+GRAPH_CACHE_MAGIC = b"RLNG"
+GRAPH_CACHE_VERSION = 3
+# Without the graph snapshot, the crawl is saved every CHECKPOINT_INTERVAL nodes so --resume can pick it up
+CRAWL_CHECKPOINT_PATH = "rebalance_network.checkpoint"
+CHECKPOINT_INTERVAL = 100
+# queryroutes answers are kept for ROUTE_CACHE_TTL seconds, for at most ROUTE_CACHE_SIZE routes
+ROUTE_CACHE_PATH = "rebalance_network.routes"
+ROUTE_CACHE_TTL = 60 * 60
+ROUTE_CACHE_SIZE = 20000
+# Routes in the graph snapshot are weighed like lnd's pathfinding weighs them: the fees,
+# plus the risk of the amount being locked up for the time lock, plus what a failed
+# attempt costs divided by the chance the route works. These are lnd's defaults.
+ROUTE_RISK_FACTOR = 15  # Per billion, for each block the amount is locked up
+ROUTE_ATTEMPT_COST = 100  # In satoshis
+ROUTE_ATTEMPT_COST_PPM = 1000
+ROUTE_HOP_PROBABILITY = 0.6  # Chance that a hop lnd knows nothing about works (its a priori estimator)
+
+
+class ChannelPolicy:
+    def __init__(self, record):
+        self.fee_base_msat = int(record["fee_base_msat"])
+        self.fee_rate_milli_msat = int(record["fee_rate_milli_msat"])
+        self.min_htlc = int(record["min_htlc"])
+        self.max_htlc_msat = int(record["max_htlc_msat"])
+        self.time_lock_delta = int(record.get("time_lock_delta", 0))
+        self.disabled = bool(record["disabled"])
+
+
+def policy_values(policy):
+    # (fee base, fee rate, min htlc, max htlc, time lock) as stored in the graph
+    if policy is None or policy.disabled:
+        return 0, 0, 0, 0, 0
+    return (policy.fee_base_msat, policy.fee_rate_milli_msat,
+            policy.min_htlc, policy.max_htlc_msat, policy.time_lock_delta)
 
 
 class RemoteChannel:
@@ -18,6 +86,23 @@ class RemoteChannel:
         self.node2_pub = record["node2_pub"]
         self.capacity = int(record["capacity"])
         self.channel_point = record["chan_point"]
+        # the policy a node charges to forward out through this channel
+        self.node1_policy = None
+        self.node2_policy = None
+        if record.get("node1_policy") is not None:
+            self.node1_policy = ChannelPolicy(record["node1_policy"])
+        if record.get("node2_policy") is not None:
+            self.node2_policy = ChannelPolicy(record["node2_policy"])
+
+    def other_node(self, pubkey):
+        if self.node1_pub == pubkey:
+            return self.node2_pub
+        return self.node1_pub
+
+    def policy_of(self, pubkey):
+        if self.node1_pub == pubkey:
+            return self.node1_policy
+        return self.node2_policy
 
 
 class RemoteNode:
@@ -40,6 +125,231 @@ class RemoteNode:
         self.remote_channels = []
 
 
+class CompactGraph:
+    # Nodes are numbered 0..n-1, and the channels of node i are the directed
+    # edges offsets[i]..offsets[i + 1] - 1 in the edge arrays (CSR layout).
+    # Each edge carries the policy of node i for forwarding out through it.
+    # The number arrays are either array.array, or memoryviews over the cache file.
+    def __init__(self):
+        self.created_at = time.time()
+        self.index = {}
+        self.pubkeys = []
+        self.aliases = []
+        self.addresses = []
+        self.num_channels = array('i')
+        self.total_capacity = array('q')
+        self.offsets = array('i', [0])
+        self.neighbors = array('i')
+        self.capacities = array('q')
+        self.fee_base_msat = array('q')
+        self.fee_rate_milli_msat = array('i')
+        self.min_htlc_msat = array('q')
+        # zero when the channel is disabled, or we have no policy for it
+        self.max_htlc_msat = array('q')
+        self.time_lock_delta = array('i')
+        self.channel_count = 0
+
+    def node_count(self):
+        return len(self.pubkeys)
+
+    def remote_node(self, node_id):
+        record = {"node": {"alias": self.aliases[node_id], "pub_key": self.pubkeys[node_id], "addresses": []},
+                  "num_channels": self.num_channels[node_id],
+                  "total_capacity": self.total_capacity[node_id]}
+        one = RemoteNode(record)
+        one.full_address = self.addresses[node_id]
+        return one
+
+    def crawl(self, source_ids, minimum_capacity):
+        # Level-by-level walk out from our peers, following only channels
+        # with enough capacity. Returns the node ids found at each distance.
+        seen = bytearray(self.node_count())
+        next_level_nodes = []
+        for node_id in source_ids:
+            if not seen[node_id]:
+                seen[node_id] = 1
+                next_level_nodes.append(node_id)
+
+        levels = []
+        for distance in range(1, MAX_NODE_DISTANCE):
+            all_nodes = next_level_nodes
+            next_level_nodes = []
+            print("Collecting channels for level", (distance + 1), "nodes:", len(all_nodes))
+            print("+" * 20)
+            for node_id in all_nodes:
+                for edge in range(self.offsets[node_id], self.offsets[node_id + 1]):
+                    peer_id = self.neighbors[edge]
+                    if self.capacities[edge] >= minimum_capacity and not seen[peer_id]:
+                        seen[peer_id] = 1
+                        next_level_nodes.append(peer_id)
+            levels.append(all_nodes)
+        return levels
+
+
+class GraphBuilder:
+    def __init__(self):
+        self.graph = CompactGraph()
+        # one entry per channel side, node1 side first
+        self.channel_nodes = array('i')
+        self.channel_capacity = array('q')
+        self.policy_fee_base_msat = array('q')
+        self.policy_fee_rate_milli_msat = array('i')
+        self.policy_min_htlc_msat = array('q')
+        self.policy_max_htlc_msat = array('q')
+        self.policy_time_lock_delta = array('i')
+
+    def node_id(self, pubkey):
+        graph = self.graph
+        if pubkey not in graph.index:
+            graph.index[pubkey] = len(graph.pubkeys)
+            graph.pubkeys.append(pubkey)
+            graph.aliases.append("")
+            graph.addresses.append(pubkey)
+            graph.num_channels.append(0)
+            graph.total_capacity.append(0)
+        return graph.index[pubkey]
+
+    def add_node(self, remote_node):
+        node_id = self.node_id(remote_node.pub_key)
+        self.graph.aliases[node_id] = remote_node.alias
+        self.graph.addresses[node_id] = remote_node.full_address
+
+    def add_channel(self, remote_channel):
+        graph = self.graph
+        graph.channel_count += 1
+        for pubkey, policy in ((remote_channel.node1_pub, remote_channel.node1_policy),
+                               (remote_channel.node2_pub, remote_channel.node2_policy)):
+            node_id = self.node_id(pubkey)
+            graph.num_channels[node_id] += 1
+            graph.total_capacity[node_id] += remote_channel.capacity
+            self.channel_nodes.append(node_id)
+            fee_base_msat, fee_rate_milli_msat, min_htlc_msat, max_htlc_msat, time_lock_delta = policy_values(policy)
+            self.policy_fee_base_msat.append(fee_base_msat)
+            self.policy_fee_rate_milli_msat.append(fee_rate_milli_msat)
+            self.policy_min_htlc_msat.append(min_htlc_msat)
+            self.policy_max_htlc_msat.append(max_htlc_msat)
+            self.policy_time_lock_delta.append(time_lock_delta)
+        self.channel_capacity.append(remote_channel.capacity)
+
+    def build(self):
+        graph = self.graph
+        node_count = graph.node_count()
+        edge_count = len(self.channel_nodes)
+
+        degree = array('i', [0]) * node_count
+        for node_id in self.channel_nodes:
+            degree[node_id] += 1
+        offsets = array('i', [0]) * (node_count + 1)
+        for node_id in range(node_count):
+            offsets[node_id + 1] = offsets[node_id] + degree[node_id]
+
+        graph.offsets = offsets
+        graph.neighbors = array('i', [0]) * edge_count
+        graph.capacities = array('q', [0]) * edge_count
+        graph.fee_base_msat = array('q', [0]) * edge_count
+        graph.fee_rate_milli_msat = array('i', [0]) * edge_count
+        graph.min_htlc_msat = array('q', [0]) * edge_count
+        graph.max_htlc_msat = array('q', [0]) * edge_count
+        graph.time_lock_delta = array('i', [0]) * edge_count
+
+        position = array('i', offsets[:node_count])
+        for side in range(edge_count):
+            # side ^ 1 is the other end of the same channel
+            node_id = self.channel_nodes[side]
+            edge = position[node_id]
+            position[node_id] += 1
+            graph.neighbors[edge] = self.channel_nodes[side ^ 1]
+            graph.capacities[edge] = self.channel_capacity[side >> 1]
+            graph.fee_base_msat[edge] = self.policy_fee_base_msat[side]
+            graph.fee_rate_milli_msat[edge] = self.policy_fee_rate_milli_msat[side]
+            graph.min_htlc_msat[edge] = self.policy_min_htlc_msat[side]
+            graph.max_htlc_msat[edge] = self.policy_max_htlc_msat[side]
+            graph.time_lock_delta[edge] = self.policy_time_lock_delta[side]
+        return graph
+
+
+# The cache file is a header, then these arrays one after another (each padded
+# to 8 bytes), then the pubkeys (33 bytes each), then aliases and addresses.
+GRAPH_CACHE_ARRAYS = (("num_channels", 'i', "nodes"), ("total_capacity", 'q', "nodes"),
+                      ("offsets", 'i', "offsets"), ("neighbors", 'i', "edges"), ("capacities", 'q', "edges"),
+                      ("fee_base_msat", 'q', "edges"), ("fee_rate_milli_msat", 'i', "edges"),
+                      ("min_htlc_msat", 'q', "edges"), ("max_htlc_msat", 'q', "edges"),
+                      ("time_lock_delta", 'i', "edges"))
+GRAPH_CACHE_HEADER = struct.Struct("<4sI?7xdqqq")  # 48 bytes, keeps the arrays 8 byte aligned
+
+
+def save_graph_cache(network_graph, path):
+    node_count = network_graph.node_count()
+    counts = {"nodes": node_count, "offsets": node_count + 1,
+              "edges": len(network_graph.neighbors)}
+    strings = [x.encode("utf-8") for x in network_graph.aliases + network_graph.addresses]
+    string_offsets = array('q', [0])
+    for one in strings:
+        string_offsets.append(string_offsets[-1] + len(one))
+
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as cache_file:
+        cache_file.write(GRAPH_CACHE_HEADER.pack(GRAPH_CACHE_MAGIC, GRAPH_CACHE_VERSION,
+                                                 sys.byteorder == "little", network_graph.created_at,
+                                                 node_count, counts["edges"], network_graph.channel_count))
+        for name, typecode, count_name in GRAPH_CACHE_ARRAYS + (("string_offsets", 'q', "strings"),):
+            if name == "string_offsets":
+                values = string_offsets
+            else:
+                values = getattr(network_graph, name)
+            cache_file.write(values.tobytes())
+            cache_file.write(b"\0" * (-cache_file.tell() % 8))
+        cache_file.write(b"".join(bytes.fromhex(x) for x in network_graph.pubkeys))
+        cache_file.write(b"".join(strings))
+    # replace the old cache in one step, so a crash never leaves half a file behind
+    os.replace(temp_path, path)
+
+
+def load_graph_cache(path):
+    try:
+        with open(path, "rb") as cache_file:
+            mapped = mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+    try:
+        magic, version, little_endian, created_at, node_count, edge_count, channel_count = \
+            GRAPH_CACHE_HEADER.unpack_from(mapped, 0)
+        if magic != GRAPH_CACHE_MAGIC or version != GRAPH_CACHE_VERSION or \
+                little_endian != (sys.byteorder == "little"):
+            return None
+        counts = {"nodes": node_count, "offsets": node_count + 1, "edges": edge_count,
+                  "strings": 2 * node_count + 1}
+
+        network_graph = CompactGraph()
+        network_graph.created_at = created_at
+        network_graph.channel_count = channel_count
+        view = memoryview(mapped)
+        position = GRAPH_CACHE_HEADER.size
+        string_offsets = None
+        for name, typecode, count_name in GRAPH_CACHE_ARRAYS + (("string_offsets", 'q', "strings"),):
+            size = counts[count_name] * array(typecode).itemsize
+            values = view[position:position + size].cast(typecode)
+            if name == "string_offsets":
+                string_offsets = values
+            else:
+                setattr(network_graph, name, values)
+            position += size + (-(position + size) % 8)
+
+        pubkey_blob = mapped[position:position + 33 * node_count]
+        position += 33 * node_count
+        network_graph.pubkeys = [pubkey_blob[x:x + 33].hex() for x in range(0, len(pubkey_blob), 33)]
+        strings = [mapped[position + string_offsets[x]:position + string_offsets[x + 1]].decode("utf-8")
+                   for x in range(2 * node_count)]
+        network_graph.aliases = strings[:node_count]
+        network_graph.addresses = strings[node_count:]
+        network_graph.index = {pubkey: node_id for node_id, pubkey in enumerate(network_graph.pubkeys)}
+    except (ValueError, TypeError, struct.error):
+        # a truncated or corrupt cache is simply fetched again
+        return None
+    return network_graph
+
+
 class Channel:
     def __init__(self, record):
         # (u'stratum+tcp://ca.stratum.slushpool.com:3333', 3, u'bluegrass.')
@@ -66,259 +376,891 @@ class Channel:
         return False
 
 
-class Commandline:
-    def __init__(self, command):
-        self.command_args = shlex.split(command)
-        self.output = ""
-        self.error = ""
-        self.exit_code = 0
+class CandidateScore:
+    def __init__(self, total_reduction, reachable_count, nodes_closer):
+        # hops saved, summed over every node we can already reach,
+        # if we opened a channel to this candidate
+        self.total_reduction = int(total_reduction)
+        self.nodes_closer = int(nodes_closer)
+        self.average_reduction = 0.0
+        if reachable_count > 0:
+            self.average_reduction = float(total_reduction) / float(reachable_count)
+
+
+class RouteCache:
+    # Least recently used queryroutes answers, keyed by (pubkey, amount)
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        # (pubkey, amount) -> [saved at, hop count, fee percentage, success probability]
+        self.entries = OrderedDict()
+        # the crawl looks up routes from several threads
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, pubkey, amount):
+        key = (pubkey, amount)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[0] >= self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return RouteSummary(hop_count=entry[1], success_prob=entry[3], fee_percentage=entry[2], tx_amount=amount)
 
-    def run(self):
+    def put(self, pubkey, amount, one_route):
+        key = (pubkey, amount)
+        with self.lock:
+            self.entries[key] = [time.time(), one_route.hop_count, one_route.fee_percentage, one_route.success_prob]
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def load(self, path):
         try:
-            stdout = subprocess.check_output(self.command_args)
-            stderr = None
-        except subprocess.CalledProcessError as err:
-            stdout = None
-            stderr = err.output
-            self.exit_code = err.returncode
-
-        if stdout is None:
-            self.output = ""
-        else:
-            self.output = stdout.decode("utf-8")
-        if stderr is None:
-            self.error = ""
+            with open(path) as cache_file:
+                records = json.load(cache_file)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        for pubkey, amount, saved_at, hop_count, fee_percentage, success_prob in records:
+            if now - saved_at < self.ttl:
+                self.entries[(pubkey, amount)] = [saved_at, hop_count, fee_percentage, success_prob]
+        # the file is in least recently used order, and may come from a run with a bigger ROUTE_CACHE_SIZE
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def save(self, path):
+        records = [[pubkey, amount] + entry for (pubkey, amount), entry in self.entries.items()]
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as cache_file:
+            json.dump(records, cache_file)
+        os.replace(temp_path, path)
+
+
+class CrawlState:
+    # Everything needed to carry on an lncli crawl where it stopped
+    def __init__(self, settings):
+        self.settings = settings
+        self.distance = 1
+        self.pubkey_hop_map = {}
+        # None until the level at self.distance has been started
+        self.frontier = None
+        # a dict keeps the to-do list in order, with constant time lookups
+        self.next_level_nodes = {}
+        # the records of the candidates reported so far
+        self.candidates = []
+
+    def save(self, path):
+        record = {"settings": self.settings,
+                  "distance": self.distance,
+                  "pubkey_hop_map": self.pubkey_hop_map,
+                  "frontier": self.frontier,
+                  "next_level_nodes": list(self.next_level_nodes),
+                  "candidates": self.candidates}
+        temp_path = path + ".tmp"
+        with gzip.open(temp_path, "wt") as checkpoint_file:
+            json.dump(record, checkpoint_file)
+        os.replace(temp_path, path)
+
+    def load(self, path):
+        # False if there is no checkpoint, or it was made with other settings
+        try:
+            with gzip.open(path, "rt") as checkpoint_file:
+                record = json.load(checkpoint_file)
+        except (OSError, ValueError):
+            return False
+        if record["settings"] != self.settings or "candidates" not in record:
+            return False
+        self.distance = record["distance"]
+        self.pubkey_hop_map = record["pubkey_hop_map"]
+        self.frontier = record["frontier"]
+        self.next_level_nodes = dict.fromkeys(record["next_level_nodes"], True)
+        self.candidates = record["candidates"]
+        return True
+
+
+class CandidateReport:
+    # Prints candidates as they are found, or writes them as one JSON object per line.
+    # With top_k set, the search stops once that many candidates have been reported.
+    def __init__(self, ndjson_output=None, top_k=0, min_score=0.0):
+        self.ndjson_output = ndjson_output
+        self.top_k = top_k
+        self.min_score = min_score
+        self.count = 0
+        self.records = []
+
+    def streaming(self):
+        return self.ndjson_output is not None or self.top_k > 0
+
+    def done(self):
+        return 0 < self.top_k <= self.count
+
+    def restore(self, records):
+        # reports again the candidates a resumed crawl had found before it stopped
+        for record in records:
+            self.count += 1
+            self.records.append(record)
+            self.write(record)
+
+    def write(self, record):
+        if self.ndjson_output is None:
+            print_candidate(record)
+            return
+        self.ndjson_output.write(json.dumps(record) + "\n")
+        self.ndjson_output.flush()
+
+    def add(self, remote_node, one_route, score=None):
+        # in graph mode a candidate is scored by the hops it saves, otherwise by its route length
+        if score is None:
+            score_value = one_route.hop_count
         else:
-            self.error = stderr.decode("utf-8")
+            score_value = score.total_reduction
+        if score_value < self.min_score:
+            return
+        self.count += 1
+        record = {"pub_key": remote_node.pub_key,
+                  "alias": remote_node.alias,
+                  "address": remote_node.full_address,
+                  "num_channels": remote_node.num_channels,
+                  "total_capacity": remote_node.total_capacity,
+                  "hop_count": one_route.hop_count,
+                  "tx_amount": one_route.tx_amount,
+                  "fee_percentage": one_route.fee_percentage,
+                  "success_prob": None if one_route.estimated else one_route.success_prob,
+                  "estimated": one_route.estimated,
+                  "score": score_value,
+                  "hops_saved": None,
+                  "average_hops_saved": None,
+                  "nodes_closer": None}
+        if score is not None:
+            record["hops_saved"] = score.total_reduction
+            record["average_hops_saved"] = score.average_reduction
+            record["nodes_closer"] = score.nodes_closer
+        self.records.append(record)
+        self.write(record)
+
+
+class JsonRecordStream:
+    # Reads the elements of the named top-level arrays of a JSON document one
+    # at a time, so memory holds one record and a chunk of text, not the document.
+    whitespace = re.compile(r"\s*")
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.position = 0
+        self.finished = False
+
+    def read_more(self):
+        self.buffer = self.buffer[self.position:]
+        self.position = 0
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.buffer += self.text_decoder.decode(b"", final=True)
+            self.finished = True
+            return False
+        self.buffer += self.text_decoder.decode(chunk)
+        return True
+
+    def next_char(self):
+        while True:
+            self.position = self.whitespace.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.read_more():
+                return ""
+
+    def expect(self, chars):
+        char = self.next_char()
+        if char not in chars:
+            raise ValueError("Expected one of {chars} but found {char!r}".format(chars=chars, char=char))
+        self.position += 1
+        return char
+
+    def read_value(self):
+        self.next_char()
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                # most likely the value runs on into the next chunk
+                if not self.read_more():
+                    raise
+                continue
+            if end == len(self.buffer) and not self.finished and isinstance(value, (int, float)):
+                # so might a number
+                self.read_more()
+                continue
+            self.position = end
+            return value
+
+    def records(self, keys):
+        if self.next_char() == "":
+            raise EOFError("No JSON found")
+        self.expect("{")
+        if self.next_char() == "}":
+            return
+        while True:
+            key = self.read_value()
+            self.expect(":")
+            if key in keys and self.next_char() == "[":
+                self.position += 1
+                if self.next_char() == "]":
+                    self.position += 1
+                else:
+                    while True:
+                        yield key, self.read_value()
+                        if self.expect(",]") == "]":
+                            break
+            else:
+                self.read_value()
+            if self.expect(",}") == "}":
+                return
 
 
 class RouteSummary:
-    def __init__(self, hop_count, success_prob=0.0, fee_percentage=0.0, tx_amount=0):
+    def __init__(self, hop_count, success_prob=0.0, fee_percentage=0.0, tx_amount=0, estimated=False):
         self.hop_count = hop_count
         self.success_prob = success_prob
         self.fee_percentage = fee_percentage
         self.tx_amount = tx_amount
+        # estimated routes come from our copy of the graph, not from lnd's pathfinding
+        self.estimated = estimated
 
 
-def get_lncli():
-    which_lncli = Commandline("which lncli")
-    which_lncli.run()
-    lncli_alias = "lncli"
-    if len(which_lncli.error) > 0:
-        print("Failed to determine where lncli is located", which_lncli.error)
+def get_own_pubkey():
+    try:
+        data = lnd.get_info()
+    except lnd_client.LndError as err:
+        print("Failed to get node info", err)
         exit(1)
-    elif len(which_lncli.output) > 0:
-        # this should work on non-umbrel nodes (but I haven't tested)
-        lncli_alias = "lncli"
-    else:
-        # docker is for running on the umbrel
-        lncli_alias = "docker exec -it lnd lncli"
-
-    if DEBUG:
-        print("Using {lncli}".format(lncli=lncli_alias))
-    return lncli_alias
+    if "identity_pubkey" not in data:
+        print("No node info found")
+        exit(2)
+    return data["identity_pubkey"]
 
 
-def get_channels():
-    listchannels = '{lncli} listchannels --active_only --public_only'.format(lncli=lncli_cmd)
-    if DEBUG:
-        print(listchannels)
-        print("-" * 15)
-    data = {}
-    list_channels = Commandline(listchannels)
-    list_channels.run()
-    if len(list_channels.error) > 0:
-        print("Failed to get channels", list_channels.error)
+def stream_records(chunks, keys, failure_message, empty_message):
+    try:
+        for key, record in JsonRecordStream(chunks).records(keys):
+            yield key, record
+    except lnd_client.LndError as err:
+        print(failure_message, err)
         exit(1)
-    elif len(list_channels.output) > 0:
-        data = json.loads(list_channels.output)
-    else:
-        print("No channels found")
+    except EOFError:
+        print(empty_message)
         exit(2)
+    except ValueError as err:
+        print(failure_message, err)
+        exit(1)
 
-    result_array = []
-    the_channels = data["channels"]
-    for channel_record in the_channels:
-        one = Channel(channel_record)
-        result_array.append(one)
 
-    return result_array
+def stream_channels():
+    for key, channel_record in stream_records(lnd.stream_channels(), ("channels",),
+                                              "Failed to get channels", "No channels found"):
+        yield Channel(channel_record)
+
+
+def get_channels():
+    return list(stream_channels())
 
 
 def get_remote_node(pubkey):
-    getnodeinfo = '{lncli} getnodeinfo --pub_key {pubkey} --include_channels true'.format(
-        lncli=lncli_cmd, pubkey=pubkey)
-    if DEBUG:
-        print(getnodeinfo)
-        print("-" * 15)
-    info_command = Commandline(getnodeinfo)
-    info_command.run()
-    if len(info_command.error) > 0:
+    try:
+        data = lnd.get_node_info(pubkey, timeout=LNCLI_TIMEOUT)
+    except lnd_client.LndError as err:
         print("Node Info Failed - Skipping {pubkey}.".format(pubkey=pubkey))
         if DEBUG:
-            print(info_command.error)
-    elif len(info_command.output) > 0:
-        data = json.loads(info_command.output)
-        the_channels = data["channels"]
-        response_node = RemoteNode(data)
-
-        for channel_record in the_channels:
-            one = RemoteChannel(channel_record)
-            response_node.remote_channels.append(one)
-        return response_node
-    else:
+            print(err)
+        return None
+    if "channels" not in data:
         print("No channels found - Skipping {pubkey}.".format(pubkey=pubkey))
+        return None
+    the_channels = data["channels"]
+    response_node = RemoteNode(data)
 
-    return None
+    for channel_record in the_channels:
+        one = RemoteChannel(channel_record)
+        response_node.remote_channels.append(one)
+    return response_node
 
 
 def get_route_length(pubkey, amount):
-    get_route = '{lncli} queryroutes --dest {pubkey} --amt {amount} '.format(
-        lncli=lncli_cmd, pubkey=pubkey, amount=amount)
-    if DEBUG:
-        print(get_route)
-        print("-" * 15)
-    route_command = Commandline(get_route)
-    route_command.run()
-    if len(route_command.error) > 0:
+    one_route = route_cache.get(pubkey, amount)
+    if one_route is None:
+        one_route = query_route_length(pubkey, amount)
+        # 0 means lncli failed for some other reason, so ask again next time
+        if one_route.hop_count != 0 and one_route.hop_count != 9999:
+            route_cache.put(pubkey, amount, one_route)
+    return one_route
+
+
+def query_route_length(pubkey, amount):
+    try:
+        data = lnd.query_routes(pubkey, amount, timeout=LNCLI_TIMEOUT)
+    except lnd_client.LndError as err:
         if DEBUG:
-            print(get_route)
-            print(route_command.error)
-        # print("-" * 15)
-        if "unable to find a path to destination" in route_command.error:
+            print(err)
+        if "unable to find a path to destination" in str(err):
             return RouteSummary(-1)
-        else:
-            print("Route Failed - {pubkey}.".format(pubkey=pubkey))
-            print(route_command.error)
-            print("-" * 33)
-    elif len(route_command.output) > 0:
-        data = json.loads(route_command.output)
-        routes = data["routes"]
-        success_prob = float(data["success_prob"])
-        response_route = RouteSummary(9999)
-        for route in routes:
-            hops = route["hops"]
-            total_fees = int(route["total_fees"])
-            total_fee_percentage = float(total_fees) / float(amount)
-            if len(hops) < response_route.hop_count:
-                response_route = RouteSummary(hop_count=len(hops),
-                                              success_prob=success_prob,
-                                              fee_percentage=total_fee_percentage,
-                                              tx_amount=amount)
-        return response_route
-    else:
+        print("Route Failed - {pubkey}.".format(pubkey=pubkey))
+        print(err)
+        print("-" * 33)
+        return RouteSummary(0)
+    if "routes" not in data:
         if DEBUG:
             print("No route found - Skipping {pubkey}.".format(pubkey=pubkey))
-    return RouteSummary(0)
-
-
-print("We're going to look at all the channels of the nodes to which you have outbound channels")
-print("   we're looking for nodes which are distant to you.")
-print("If you had a direct connection to a sufficiently distant node, ")
-print("   you'll cut the path in half to any node on the route.")
-print("+" * 20)
-
-minimum_distance = input('What is the shortest route to consider?: (Default: {default}) '.format(
-    default=MINIMUM_NODE_DISTANCE))
-if len(minimum_distance) == 0 or int(minimum_distance) <= 0:
-    minimum_distance = MINIMUM_NODE_DISTANCE
-else:
-    minimum_distance = int(minimum_distance)
-
-minimum_capacity = input('Minimum channel capacity to consider nodes?: (Default: {default}) '.format(
-    default=MIN_CHANNEL_CAPACITY))
-if len(minimum_capacity) == 0 or int(minimum_capacity) <= 0:
-    minimum_capacity = MIN_CHANNEL_CAPACITY
-else:
-    minimum_capacity = int(minimum_capacity)
-
-lncli_cmd = get_lncli()
-all_channels = get_channels()
-print("")
-print("Collecting information on your channels:", len(all_channels))
-print("+" * 20)
-
-pubkey_hop_map = {}
-next_level_nodes = []
-for one_channel in all_channels:
-    if one_channel.remote_pubkey not in next_level_nodes:
-        next_level_nodes.append(one_channel.remote_pubkey)
-
-for distance in range(1, MAX_NODE_DISTANCE):
-    all_pubkeys = next_level_nodes
-    next_level_nodes = []
-    print("Collecting channels for level", (distance + 1), "nodes:", len(all_pubkeys))
+        return RouteSummary(0)
+    routes = data["routes"]
+    success_prob = float(data["success_prob"])
+    response_route = RouteSummary(9999)
+    for route in routes:
+        hops = route["hops"]
+        total_fees = int(route["total_fees"])
+        total_fee_percentage = float(total_fees) / float(amount)
+        if len(hops) < response_route.hop_count:
+            response_route = RouteSummary(hop_count=len(hops),
+                                          success_prob=success_prob,
+                                          fee_percentage=total_fee_percentage,
+                                          tx_amount=amount)
+    return response_route
+
+
+def stream_network_graph():
+    # describegraph lists every node first, then every channel
+    for key, record in stream_records(lnd.stream_graph(), ("nodes", "edges"),
+                                      "Failed to describe the network graph", "No network graph found"):
+        if key == "nodes":
+            yield RemoteNode({"node": record, "num_channels": 0, "total_capacity": 0})
+        else:
+            yield RemoteChannel(record)
+
+
+def get_network_graph():
+    cached_graph = None
+    if GRAPH_CACHE_TTL > 0:
+        cached_graph = load_graph_cache(GRAPH_CACHE_PATH)
+    if cached_graph is not None:
+        cache_age = time.time() - cached_graph.created_at
+        if cache_age < GRAPH_CACHE_TTL:
+            print("Using the network graph saved {minutes:0.0f} minutes ago".format(minutes=cache_age / 60))
+            return cached_graph
+
+    # describegraph has no per-node totals, so we add them up from the edges
+    builder = GraphBuilder()
+    for one in stream_network_graph():
+        if isinstance(one, RemoteNode):
+            builder.add_node(one)
+        else:
+            builder.add_channel(one)
+    network_graph = builder.build()
+    if GRAPH_CACHE_TTL > 0:
+        save_graph_cache(network_graph, GRAPH_CACHE_PATH)
+    return network_graph
+
+
+def find_local_routes(network_graph, own_id, amount):
+    # Dijkstra from our node over the same cost lnd's pathfinding uses, so the route
+    # to each node is the one queryroutes would most likely pick, not the one with fewest hops.
+    # Channels too small for the amount, or disabled, are left out.
+    # Returns the hop count (-1 when unreachable) and fee for every node id.
+    amount_msat = amount * 1000
+    attempt_cost_msat = ROUTE_ATTEMPT_COST * 1000 + amount_msat * ROUTE_ATTEMPT_COST_PPM / 1000000
+    node_count = network_graph.node_count()
+    hops = array('i', [-1]) * node_count
+    fees = array('q', [0]) * node_count
+    # fees plus the time lock risk, and the chance the route so far works
+    weights = [0.0] * node_count
+    probabilities = [1.0] * node_count
+    done = bytearray(node_count)
+    hops[own_id] = 0
+    queue = [(attempt_cost_msat, own_id)]
+    while len(queue) > 0:
+        cost, node_id = heapq.heappop(queue)
+        if done[node_id]:
+            continue
+        done[node_id] = 1
+        hop_count = hops[node_id]
+        for edge in range(network_graph.offsets[node_id], network_graph.offsets[node_id + 1]):
+            if network_graph.capacities[edge] < amount:
+                continue
+            if not network_graph.min_htlc_msat[edge] <= amount_msat <= network_graph.max_htlc_msat[edge]:
+                continue
+            peer_id = network_graph.neighbors[edge]
+            if done[peer_id]:
+                continue
+            next_fee_msat = fees[node_id]
+            next_weight = weights[node_id]
+            next_probability = probabilities[node_id]
+            if node_id != own_id:
+                # we don't pay ourselves to use our own channels, and we know they work
+                edge_fee_msat = network_graph.fee_base_msat[edge] + \
+                    (amount_msat * network_graph.fee_rate_milli_msat[edge]) // 1000000
+                next_fee_msat += edge_fee_msat
+                next_weight += edge_fee_msat + \
+                    amount_msat * network_graph.time_lock_delta[edge] * ROUTE_RISK_FACTOR / 1000000000
+                next_probability *= ROUTE_HOP_PROBABILITY
+            next_cost = next_weight + attempt_cost_msat / next_probability
+            if hops[peer_id] == -1 or next_cost < weights[peer_id] + attempt_cost_msat / probabilities[peer_id]:
+                hops[peer_id] = hop_count + 1
+                fees[peer_id] = next_fee_msat
+                weights[peer_id] = next_weight
+                probabilities[peer_id] = next_probability
+                heapq.heappush(queue, (next_cost, peer_id))
+    return hops, fees
+
+
+def local_route(routes, node_id, amount):
+    hops, fees = routes
+    return RouteSummary(hop_count=hops[node_id],
+                        fee_percentage=float(fees[node_id]) / float(amount * 1000),
+                        tx_amount=amount,
+                        estimated=True)
+
+
+def graph_distances(network_graph, source_id, minimum_capacity):
+    distances = array('i', [-1]) * network_graph.node_count()
+    distances[source_id] = 0
+    queue = deque([source_id])
+    while len(queue) > 0:
+        node_id = queue.popleft()
+        for edge in range(network_graph.offsets[node_id], network_graph.offsets[node_id + 1]):
+            peer_id = network_graph.neighbors[edge]
+            if network_graph.capacities[edge] >= minimum_capacity and distances[peer_id] == -1:
+                distances[peer_id] = distances[node_id] + 1
+                queue.append(peer_id)
+    return distances
+
+
+class CandidateScorer:
+    # A channel to candidate c brings node v to min(d(v), 1 + d_c(v)) hops away,
+    # where d is the distance from us and d_c the distance from c. Everything that doesn't
+    # depend on the candidates is worked out once, and reused for every batch.
+    def __init__(self, network_graph, own_id, minimum_capacity):
+        self.network_graph = network_graph
+        self.minimum_capacity = minimum_capacity
+        self.forward = None
+        if numpy is not None:
+            node_count = network_graph.node_count()
+            followed = numpy.frombuffer(network_graph.capacities, dtype=numpy.int64) >= minimum_capacity
+            adjacency = sparse.csr_matrix((followed.astype(numpy.float32),
+                                           numpy.frombuffer(network_graph.neighbors, dtype=numpy.int32),
+                                           numpy.frombuffer(network_graph.offsets, dtype=numpy.int32)),
+                                          shape=(node_count, node_count))
+            self.forward = adjacency.T.tocsr()
+            self.own_distances = self.batch_distances([own_id])[:, 0]
+            self.reachable = self.own_distances > 0
+            self.reachable_count = int(self.reachable.sum())
+        else:
+            self.own_distances = graph_distances(network_graph, own_id, minimum_capacity)
+            self.reachable_count = sum(1 for x in self.own_distances if x > 0)
+
+    def score(self, candidate_ids):
+        if self.forward is not None:
+            return self.score_sparse(candidate_ids)
+        return self.score_bitsets(candidate_ids)
+
+    def batch_distances(self, source_ids):
+        # Breadth-first search from a whole batch at once: column j of the frontier
+        # matrix is the search from source j, and one sparse matrix product moves
+        # every search out by one hop
+        node_count = self.network_graph.node_count()
+        distances = numpy.full((node_count, len(source_ids)), -1, dtype=numpy.int32)
+        frontier = numpy.zeros((node_count, len(source_ids)), dtype=bool)
+        frontier[source_ids, numpy.arange(len(source_ids))] = True
+        distances[frontier] = 0
+        hop_count = 0
+        while frontier.any():
+            hop_count += 1
+            frontier = (self.forward @ frontier.astype(numpy.float32) > 0) & (distances < 0)
+            distances[frontier] = hop_count
+        return distances
+
+    def score_sparse(self, candidate_ids):
+        scores = {}
+        for start in range(0, len(candidate_ids), SCORE_BATCH_SIZE):
+            batch_ids = candidate_ids[start:start + SCORE_BATCH_SIZE]
+            candidate_distances = self.batch_distances(batch_ids)
+            saved = self.own_distances[:, None] - candidate_distances - 1
+            saved[(candidate_distances < 0) | (saved < 0) | ~self.reachable[:, None]] = 0
+            for column, candidate_id in enumerate(batch_ids):
+                scores[candidate_id] = CandidateScore(saved[:, column].sum(), self.reachable_count,
+                                                      numpy.count_nonzero(saved[:, column]))
+        return scores
+
+    def score_bitsets(self, candidate_ids):
+        # The same search in plain python: bit j of reached[v] is set once the search
+        # from candidate j got to v, so each hop is one pass over the edges for all of them
+        network_graph = self.network_graph
+        offsets = network_graph.offsets
+        neighbors = network_graph.neighbors
+        capacities = network_graph.capacities
+        own_distances = self.own_distances
+        reached = [0] * network_graph.node_count()
+        frontier = {}
+        for column, candidate_id in enumerate(candidate_ids):
+            reached[candidate_id] |= 1 << column
+            frontier[candidate_id] = frontier.get(candidate_id, 0) | (1 << column)
+        total_reductions = [0] * len(candidate_ids)
+        nodes_closer = [0] * len(candidate_ids)
+        hop_count = 0
+        while len(frontier) > 0:
+            for node_id, bits in frontier.items():
+                saved = own_distances[node_id] - hop_count - 1
+                if own_distances[node_id] <= 0 or saved <= 0:
+                    continue
+                while bits:
+                    lowest = bits & -bits
+                    column = lowest.bit_length() - 1
+                    total_reductions[column] += saved
+                    nodes_closer[column] += 1
+                    bits ^= lowest
+            hop_count += 1
+            next_frontier = {}
+            for node_id, bits in frontier.items():
+                for edge in range(offsets[node_id], offsets[node_id + 1]):
+                    if capacities[edge] < self.minimum_capacity:
+                        continue
+                    peer_id = neighbors[edge]
+                    new_bits = bits & ~reached[peer_id]
+                    if new_bits:
+                        reached[peer_id] |= new_bits
+                        next_frontier[peer_id] = next_frontier.get(peer_id, 0) | new_bits
+            frontier = next_frontier
+        scores = {}
+        for column, candidate_id in enumerate(candidate_ids):
+            scores[candidate_id] = CandidateScore(total_reductions[column], self.reachable_count,
+                                                  nodes_closer[column])
+        return scores
+
+
+def print_candidate(record):
+    # record is a candidate as CandidateReport.add() describes it
+    pubkey = record["pub_key"]
+    print("   Here is a good candidate node:", pubkey)
+    print("   Alias:", record["alias"])
+    print("   1ml: https://1ml.com/node/{pubkey}".format(pubkey=pubkey))
+    print("   Terminal Web: https://terminal.lightning.engineering/#/{pubkey}".format(pubkey=pubkey))
+    print("   Amboss: https://amboss.space/node/026209{pubkey}".format(pubkey=pubkey))
+    print("   Addr:", record["address"])
+    print("   Channels:", record["num_channels"])
+    total_btc = record["total_capacity"] / 100000000
+    print("   Total Capacity:", "{:0.2f} BTC".format(float(total_btc)))
+    print("   Number of hops:", record["hop_count"])
+    print("   TX Amount:", record["tx_amount"])
+    if record["estimated"]:
+        print("   Estimated Fee Percentage:", "{:0.2f}%".format((record["fee_percentage"] * 100)))
+    else:
+        print("   Fee Percentage:", "{:0.2f}%".format((record["fee_percentage"] * 100)))
+        print("   Success Probability:", "{:0.2f}%".format((record["success_prob"] * 100)))
+    if record["hops_saved"] is not None:
+        print("   Hops saved:", record["hops_saved"], "across", record["nodes_closer"], "nodes")
+        print("   Average hops saved:", "{:0.3f}".format(record["average_hops_saved"]))
+    print("-" * 33)
+
+
+def print_unreachable(remote_node):
+    print("     Failed to create route to", remote_node.pub_key)
+    print("         This node could be offline.")
+    print("         or there might be no routes available.")
+    print("     Alias:", remote_node.alias)
+    print("     1ml: https://1ml.com/node/{pubkey}".format(pubkey=remote_node.pub_key))
+    print("     Terminal Web: https://terminal.lightning.engineering/#/{pubkey}".format(
+        pubkey=remote_node.pub_key))
+    print(
+        "     Amboss: https://amboss.space/node/026209{pubkey}".format(pubkey=remote_node.pub_key))
+    print("     Addr:", remote_node.full_address)
+    print("     Channels:", remote_node.num_channels)
+    total_btc = remote_node.total_capacity / 100000000
+    print("     Total Capacity:", "{:0.2f} BTC".format(float(total_btc)))
+    print("-" * 33)
+
+
+def is_candidate(remote_node):
+    total_btc = remote_node.total_capacity / 100000000
+    return remote_node.num_channels > MINIMUM_CHANNEL_COUNT and total_btc >= MINIMUM_BTC_COUNT
+
+
+def is_graph_candidate(network_graph, node_id):
+    total_btc = network_graph.total_capacity[node_id] / 100000000
+    return network_graph.num_channels[node_id] > MINIMUM_CHANNEL_COUNT and total_btc >= MINIMUM_BTC_COUNT
+
+
+def find_candidate_route(remote_node, minimum_distance):
+    one_route = get_route_length(remote_node.pub_key, 1500)  # Around $0.50 USD
+    if one_route.hop_count < minimum_distance:
+        one_route = get_route_length(remote_node.pub_key, 500000)  # Around $150 USD
+    return one_route
+
+
+def check_candidates(remote_nodes, minimum_distance, executor, report):
+    # skip nodes with too few channels, or too little capacity
+    candidates = [x for x in remote_nodes if is_candidate(x)]
+    # map() hands back the routes in candidate order, whichever finishes first
+    routes = executor.map(lambda x: find_candidate_route(x, minimum_distance), candidates)
+    for remote_node, one_route in zip(candidates, routes):
+        if one_route.hop_count >= minimum_distance:
+            report.add(remote_node, one_route)
+            if report.done():
+                # drop the route lookups still waiting their turn
+                executor.shutdown(wait=False, cancel_futures=True)
+                return True
+        elif one_route.hop_count == -1:
+            print_unreachable(remote_node)
+    return False
+
+
+def report_graph_candidate(network_graph, node_id, one_route, score, minimum_distance, report):
+    remote_node = network_graph.remote_node(node_id)
+    if report.count < CONFIRM_TOP_N:
+        confirmed_route = get_route_length(remote_node.pub_key, one_route.tx_amount)
+        if confirmed_route.hop_count > 0:
+            if confirmed_route.hop_count < minimum_distance:
+                # lnd knows a shorter way there than our copy of the graph
+                return
+            one_route = confirmed_route
+    report.add(remote_node, one_route, score)
+
+
+def check_graph_candidates(network_graph, candidate_ids, minimum_distance, minimum_capacity, report):
+    own_pubkey = get_own_pubkey()
+    print("Finding routes to", len(candidate_ids), "candidate nodes")
     print("+" * 20)
-    for one_pubkey in all_pubkeys:
-        if DEBUG:
-            print("---", one_pubkey)
-        remote_node = None
-        if one_pubkey not in pubkey_hop_map:
-            remote_node = get_remote_node(one_pubkey)
-        if remote_node is not None and remote_node.pub_key not in pubkey_hop_map:
-            # This node has not been seen previously
-            # so it is probably worth digging in here
-            # if it is far enough away, we can choose this node as a candidate
-            # if it is not far enough away, we dive deeper to this node's peers
-            pubkey_hop_map[remote_node.pub_key] = distance
-            for one_remote_channel in remote_node.remote_channels:
-                # If this channel has enough capacity
-                if one_remote_channel.capacity >= minimum_capacity:
-                    # If this node isn't already in our to-do list
-                    if one_remote_channel.node2_pub not in next_level_nodes:
-                        # if this node wasn't visited on a previous level
-                        if one_remote_channel.node2_pub not in pubkey_hop_map:
-                            next_level_nodes.append(one_remote_channel.node2_pub)
-                elif DEBUG:
-                    print("-- This node has a channel too small to follow:", remote_node.pub_key)
-                    print("   Destination node:", one_remote_channel.node2_pub)
-                    print("   Capacity:", one_remote_channel.capacity)
-
-            if distance >= 2:
-                total_btc = remote_node.total_capacity / 100000000
-                if remote_node.num_channels > MINIMUM_CHANNEL_COUNT and total_btc >= MINIMUM_BTC_COUNT:
-                    one_route = get_route_length(remote_node.pub_key, 1500)  # Around $0.50 USD
-                    if one_route.hop_count < minimum_distance:
-                        one_route = get_route_length(remote_node.pub_key, 500000)  # Around $150 USD
-                    if one_route.hop_count >= minimum_distance:
-                        print("   Here is a good candidate node:", remote_node.pub_key)
-                        print("   Alias:", remote_node.alias)
-                        print("   1ml: https://1ml.com/node/{pubkey}".format(pubkey=remote_node.pub_key))
-                        print("   Terminal Web: https://terminal.lightning.engineering/#/{pubkey}".format(
-                            pubkey=remote_node.pub_key))
-                        print("   Amboss: https://amboss.space/node/026209{pubkey}".format(pubkey=remote_node.pub_key))
-                        print("   Addr:", remote_node.full_address)
-                        print("   Channels:", remote_node.num_channels)
-                        total_btc = remote_node.total_capacity / 100000000
-                        print("   Total Capacity:", "{:0.2f} BTC".format(float(total_btc)))
-                        print("   Number of hops:", one_route.hop_count)
-                        print("   TX Amount:", one_route.tx_amount)
-                        print("   Fee Percentage:", "{:0.2f}%".format((one_route.fee_percentage * 100)))
-                        print("   Success Probability:", "{:0.2f}%".format((one_route.success_prob * 100)))
-                        print("-" * 33)
-                    elif one_route.hop_count == -1:
-                        print("     Failed to create route to", remote_node.pub_key)
-                        print("         This node could be offline.")
-                        print("         or there might be no routes available.")
-                        print("     Alias:", remote_node.alias)
-                        print("     1ml: https://1ml.com/node/{pubkey}".format(pubkey=remote_node.pub_key))
-                        print("     Terminal Web: https://terminal.lightning.engineering/#/{pubkey}".format(
-                            pubkey=remote_node.pub_key))
-                        print(
-                            "     Amboss: https://amboss.space/node/026209{pubkey}".format(pubkey=remote_node.pub_key))
-                        print("     Addr:", remote_node.full_address)
-                        print("     Channels:", remote_node.num_channels)
-                        print("     Total Capacity:", "{:0.2f} BTC".format(float(total_btc)))
-                        print("-" * 33)
+    if own_pubkey not in network_graph.index:
+        print("Our node is not in the network graph", own_pubkey)
+        exit(1)
+    own_id = network_graph.index[own_pubkey]
+    small_routes = find_local_routes(network_graph, own_id, 1500)  # Around $0.50 USD
+    large_routes = find_local_routes(network_graph, own_id, 500000)  # Around $150 USD
+
+    good_candidates = []
+    for node_id in candidate_ids:
+        one_route = local_route(small_routes, node_id, 1500)
+        if one_route.hop_count < minimum_distance:
+            one_route = local_route(large_routes, node_id, 500000)
+        if one_route.hop_count >= minimum_distance:
+            good_candidates.append((node_id, one_route))
+        elif one_route.hop_count == -1:
+            print_unreachable(network_graph.remote_node(node_id))
+
+    print("Scoring", len(good_candidates), "distant nodes")
+    print("+" * 20)
+    scorer = CandidateScorer(network_graph, own_id, minimum_capacity)
+    if report.streaming():
+        # report each batch as soon as it is scored, nearest levels first
+        for start in range(0, len(good_candidates), SCORE_BATCH_SIZE):
+            batch = good_candidates[start:start + SCORE_BATCH_SIZE]
+            scores = scorer.score([x[0] for x in batch])
+            for node_id, one_route in batch:
+                report_graph_candidate(network_graph, node_id, one_route, scores[node_id], minimum_distance, report)
+                if report.done():
+                    return
+        return
+
+    scores = scorer.score([x[0] for x in good_candidates])
+    # most hops saved first, then longest routes, then the cheapest
+    good_candidates.sort(key=lambda x: (-scores[x[0]].total_reduction, -x[1].hop_count, x[1].fee_percentage))
+    for node_id, one_route in good_candidates:
+        report_graph_candidate(network_graph, node_id, one_route, scores[node_id], minimum_distance, report)
+
+
+def crawl_network(crawl_state, minimum_capacity, lookup_node, on_nodes, executor=None, checkpoint_path=None):
+    # Returns True if on_nodes asked to stop before the crawl was finished
+    pubkey_hop_map = crawl_state.pubkey_hop_map
+    while crawl_state.distance < MAX_NODE_DISTANCE:
+        distance = crawl_state.distance
+        if crawl_state.frontier is None:
+            crawl_state.frontier = [x for x in crawl_state.next_level_nodes if x not in pubkey_hop_map]
+            crawl_state.next_level_nodes = {}
+            print("Collecting channels for level", (distance + 1), "nodes:", len(crawl_state.frontier))
+            print("+" * 20)
+        next_level_nodes = crawl_state.next_level_nodes
+
+        while len(crawl_state.frontier) > 0:
+            all_pubkeys = crawl_state.frontier[:CHECKPOINT_INTERVAL]
+            # Look up a batch at once, then merge the answers in the order
+            # the level was built, so the result doesn't depend on which lookup finished first
+            if executor is None:
+                remote_nodes = [lookup_node(x) for x in all_pubkeys]
+            else:
+                remote_nodes = list(executor.map(lookup_node, all_pubkeys))
+            level_candidates = []
+            for one_pubkey, remote_node in zip(all_pubkeys, remote_nodes):
+                if DEBUG:
+                    print("---", one_pubkey)
+                if remote_node is not None and remote_node.pub_key not in pubkey_hop_map:
+                    # This node has not been seen previously
+                    # so it is probably worth digging in here
+                    # if it is far enough away, we can choose this node as a candidate
+                    # if it is not far enough away, we dive deeper to this node's peers
+                    pubkey_hop_map[remote_node.pub_key] = distance
+                    for one_remote_channel in remote_node.remote_channels:
+                        peer_pubkey = one_remote_channel.other_node(remote_node.pub_key)
+                        # If this channel has enough capacity
+                        if one_remote_channel.capacity >= minimum_capacity:
+                            # If this node isn't already in our to-do list
+                            if peer_pubkey not in next_level_nodes:
+                                # if this node wasn't visited on a previous level
+                                if peer_pubkey not in pubkey_hop_map:
+                                    next_level_nodes[peer_pubkey] = True
+                        elif DEBUG:
+                            print("-- This node has a channel too small to follow:", remote_node.pub_key)
+                            print("   Destination node:", peer_pubkey)
+                            print("   Capacity:", one_remote_channel.capacity)
+
+                    if distance >= 2:
+                        level_candidates.append(remote_node)
+                    elif DEBUG:
+                        print("-- This node is too close:", remote_node.pub_key)
+                        print("   Distance:", distance)
                 else:
-                    # this node has too few channels, or too little capacity
+                    # we have already seen this node. Nothing to do here.
+                    if DEBUG:
+                        print("--- None response, or already seen pub_key", remote_node)
                     pass
+            crawl_state.frontier = crawl_state.frontier[len(all_pubkeys):]
+            stop = on_nodes(level_candidates)
+            if checkpoint_path is not None:
+                crawl_state.save(checkpoint_path)
+            if stop:
+                return True
+
+        crawl_state.frontier = None
+        crawl_state.distance += 1
+    return False
+
+
+lnd = None
+route_cache = None
+
+
+def find_distant_nodes(min_distance=None, min_capacity=None, report=None, resume=False):
+    # The whole search. Asks for whatever is left as None, unless the report is written as ndjson.
+    # Without a report, candidates are printed.
+    global lnd, route_cache
+    if report is None:
+        report = CandidateReport()
+    asking = report.ndjson_output is None
+    print("We're going to look at all the channels of the nodes to which you have outbound channels")
+    print("   we're looking for nodes which are distant to you.")
+    print("If you had a direct connection to a sufficiently distant node, ")
+    print("   you'll cut the path in half to any node on the route.")
+    print("+" * 20)
+
+    if min_distance is not None:
+        minimum_distance = min_distance
+    elif not asking:
+        minimum_distance = MINIMUM_NODE_DISTANCE
+    else:
+        minimum_distance = input('What is the shortest route to consider?: (Default: {default}) '.format(
+            default=MINIMUM_NODE_DISTANCE))
+        if len(minimum_distance) == 0 or int(minimum_distance) <= 0:
+            minimum_distance = MINIMUM_NODE_DISTANCE
+        else:
+            minimum_distance = int(minimum_distance)
+
+    if min_capacity is not None:
+        minimum_capacity = min_capacity
+    elif not asking:
+        minimum_capacity = MIN_CHANNEL_CAPACITY
+    else:
+        minimum_capacity = input('Minimum channel capacity to consider nodes?: (Default: {default}) '.format(
+            default=MIN_CHANNEL_CAPACITY))
+        if len(minimum_capacity) == 0 or int(minimum_capacity) <= 0:
+            minimum_capacity = MIN_CHANNEL_CAPACITY
+        else:
+            minimum_capacity = int(minimum_capacity)
 
-            elif DEBUG:
-                print("-- This node is too close:", remote_node.pub_key)
-                print("   Distance:", distance)
+    lnd = lnd_client.connect()
+    route_cache = RouteCache(ROUTE_CACHE_SIZE, ROUTE_CACHE_TTL)
+    route_cache.load(ROUTE_CACHE_PATH)
+    all_channels = get_channels()
+    print("")
+    print("Collecting information on your channels:", len(all_channels))
+    print("+" * 20)
+
+    if USE_GRAPH_SNAPSHOT:
+        print("Loading the network graph")
+        print("+" * 20)
+        network_graph = get_network_graph()
+        source_ids = [network_graph.index[x.remote_pubkey] for x in all_channels
+                      if x.remote_pubkey in network_graph.index]
+        graph_levels = network_graph.crawl(source_ids, minimum_capacity)
+        graph_candidates = []
+        # the first level is our own peers
+        for level_ids in graph_levels[1:]:
+            graph_candidates.extend(x for x in level_ids if is_graph_candidate(network_graph, x))
+        check_graph_candidates(network_graph, graph_candidates, minimum_distance, minimum_capacity, report)
+    else:
+        crawl_state = CrawlState({"minimum_distance": minimum_distance, "minimum_capacity": minimum_capacity,
+                                  "min_score": report.min_score, "top_k": report.top_k})
+        if resume and crawl_state.load(CRAWL_CHECKPOINT_PATH):
+            print("Resuming the crawl at level", (crawl_state.distance + 1), "with",
+                  len(crawl_state.pubkey_hop_map), "nodes already seen")
+            print("+" * 20)
+            report.restore(crawl_state.candidates)
         else:
-            # we have already seen this node. Nothing to do here.
-            if DEBUG:
-                print("--- None response, or already seen pub_key", remote_node)
-            pass
+            if resume:
+                print("No checkpoint found for these settings, starting from the beginning")
+            for one_channel in all_channels:
+                crawl_state.next_level_nodes[one_channel.remote_pubkey] = True
+
+        # the checkpoint saves the report's records as they grow
+        crawl_state.candidates = report.records
+
+        def check_crawled_nodes(remote_nodes):
+            return check_candidates(remote_nodes, minimum_distance, crawl_executor, report)
+
+        if not report.done():
+            with ThreadPoolExecutor(max_workers=CRAWL_CONCURRENCY) as crawl_executor:
+                crawl_network(crawl_state, minimum_capacity, get_remote_node, check_crawled_nodes,
+                              executor=crawl_executor, checkpoint_path=CRAWL_CHECKPOINT_PATH)
+        # nothing left to resume
+        if os.path.exists(CRAWL_CHECKPOINT_PATH):
+            os.remove(CRAWL_CHECKPOINT_PATH)
+
+    route_cache.save(ROUTE_CACHE_PATH)
+    print("Route cache:", route_cache.hits, "hits,", route_cache.misses, "misses")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Find distant nodes worth opening a channel to.")
+    parser.add_argument("--min-distance", type=int,
+                        help="shortest route to consider (default: {default})".format(default=MINIMUM_NODE_DISTANCE))
+    parser.add_argument("--min-capacity", type=int,
+                        help="minimum channel capacity to follow (default: {default})".format(
+                            default=MIN_CHANNEL_CAPACITY))
+    parser.add_argument("--ndjson", action="store_true",
+                        help="write each candidate to stdout as one JSON object per line, without asking questions")
+    parser.add_argument("--top-k", type=int, default=0,
+                        help="stop once this many candidates have been found")
+    parser.add_argument("--resume", action="store_true",
+                        help="carry on from the last checkpoint of an lncli crawl (without the graph snapshot)")
+    parser.add_argument("--min-score", type=float, default=0.0,
+                        help="only report candidates scoring at least this much "
+                             "(hops saved with the graph snapshot, route length otherwise)")
+    arguments = parser.parse_args(argv)
+
+    candidate_output = None
+    if arguments.ndjson:
+        # keep stdout for the candidates, everything else goes to stderr
+        candidate_output = sys.stdout
+        sys.stdout = sys.stderr
+    try:
+        find_distant_nodes(arguments.min_distance, arguments.min_capacity,
+                           CandidateReport(candidate_output, arguments.top_k, arguments.min_score), arguments.resume)
+    finally:
+        if candidate_output is not None:
+            sys.stdout = candidate_output
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,14 @@
+import argparse
+import hashlib
 import json
-import shlex
-import subprocess
+import os
+
+import lnd_client
 
 DEBUG = False
 DEFAULT_MAX_FEE = 50
+# Pay the ring with keysend instead of an invoice, lnd has to run with accept-keysend=true
+USE_KEYSEND = False
 
 
 class Channel:
@@ -32,37 +37,6 @@ class Channel:
         return False
 
 
-class Commandline:
-    def __init__(self, command):
-        self.command_args = shlex.split(command)
-        self.output = ""
-        self.error = ""
-        self.exit_code = 0
-
-    def run(self):
-
-        try:
-            stdout = subprocess.check_output(self.command_args)
-            stderr = None
-        except subprocess.CalledProcessError as err:
-            # print("+" * 20)
-            # print("Command failure:", err.returncode)
-            # print(err.output.decode("utf-8"))
-            # print("+" * 20)
-            stdout = None
-            stderr = err.output
-            self.exit_code = err.returncode
-
-        if stdout is None:
-            self.output = ""
-        else:
-            self.output = stdout.decode("utf-8")
-        if stderr is None:
-            self.error = ""
-        else:
-            self.error = stderr.decode("utf-8")
-
-
 class PaymentInvoice:
     def __init__(self, record):
         self.r_hash = record["r_hash"]
@@ -72,8 +46,8 @@ class PaymentInvoice:
 
 
 class PaymentRoute:
-    def __init__(self, json_string):
-        obj = json.loads(json_string)
+    def __init__(self, obj):
+        # buildroute output
         route = obj["route"]
 
         self.route_object = obj
@@ -94,6 +68,21 @@ class PaymentRoute:
         route_object["hops"] = hops_object
         self.route_object["route"] = route_object
 
+    def add_keysend(self, preimage_hex):
+        # The last hop is our own node: the preimage travels in the keysend record
+        route_object = self.route_object["route"]
+        hops_object = route_object["hops"]
+        hops_count = len(hops_object)
+        one_hop = hops_object[(hops_count - 1)]
+        custom_records = one_hop.get("custom_records", {})
+        custom_records[lnd_client.KEYSEND_RECORD_TYPE] = preimage_hex
+        one_hop["custom_records"] = custom_records
+        one_hop.pop("mpp_record", None)
+
+        hops_object[(hops_count - 1)] = one_hop
+        route_object["hops"] = hops_object
+        self.route_object["route"] = route_object
+
     def describe_fees(self):
         route_object = self.route_object["route"]
         hops_object = route_object["hops"]
@@ -121,39 +110,13 @@ class PaymentRoute:
         return "\n\n".join(summary)
 
 
-def get_lncli():
-    which_lncli = Commandline("which lncli")
-    which_lncli.run()
-    lncli_alias = "lncli"
-    if len(which_lncli.error) > 0:
-        print("Failed to determine where lncli is located", which_lncli.error)
-        exit(1)
-    elif len(which_lncli.output) > 0:
-        # this should work on non-umbrel nodes (but I haven't tested)
-        lncli_alias = "lncli"
-    else:
-        # docker is for running on the umbrel
-        lncli_alias = "docker exec -it lnd lncli"
-
-    if DEBUG:
-        print("Using {lncli}".format(lncli=lncli_alias))
-    return lncli_alias
-
-
 def get_channels():
-    listchannels = '{lncli} listchannels --active_only --public_only'.format(lncli=lncli_cmd)
-    if DEBUG:
-        print(listchannels)
-        print("-" * 15)
-    data = {}
-    list_channels = Commandline(listchannels)
-    list_channels.run()
-    if len(list_channels.error) > 0:
-        print("Failed to get channels", list_channels.error)
+    try:
+        data = lnd.list_channels()
+    except lnd_client.LndError as err:
+        print("Failed to get channels", err)
         exit(1)
-    elif len(list_channels.output) > 0:
-        data = json.loads(list_channels.output)
-    else:
+    if "channels" not in data:
         print("No channels found")
         exit(2)
 
@@ -167,23 +130,14 @@ def get_channels():
 
 
 def create_invoice(invoice_amount, memo_str, expiry_sec):
-    addinvoice = '{lncli} addinvoice --expiry {seconds} --memo "{memo}" --amt {amount}'.format(
-        lncli=lncli_cmd, seconds=expiry_sec, memo=memo_str, amount=invoice_amount)
+    try:
+        the_invoice = lnd.add_invoice(invoice_amount, memo_str, expiry_sec)
+    except lnd_client.LndError as err:
+        print("Failed to run invoice creation", err)
+        exit(1)
     if DEBUG:
-        print(addinvoice)
+        print(the_invoice)
         print("-" * 15)
-    add_command = Commandline(addinvoice)
-    add_command.run()
-    the_invoice = ""
-    if len(add_command.error) > 0:
-        print("Failed to run invoice creation", add_command.error)
-        exit(1)
-    elif len(add_command.output) > 0:
-        invoice_json = json.loads(add_command.output)
-        if DEBUG:
-            print(invoice_json)
-            print("-" * 15)
-        the_invoice = invoice_json
 
     if len(the_invoice) == 0:
         print("Failed to create an invoice")
@@ -199,138 +153,56 @@ def create_fee_recovery_invoice(invoice_amount):
     return create_invoice(invoice_amount, "Reimburse Balance Fees", 3600)
 
 
-lncli_cmd = get_lncli()
-all_channels = get_channels()
+# set by setup()
+lnd = None
 
-pub_keys = []
-your_pub_key = ""
 
-print("Enter all of the node ids in your ring.")
-print("Start with the node where you have outbound liquidity.")
-print("End with your node.")
-print("---------------------------------------------------------")
-print("Signal that you're done entering nodes with a blank line.")
-print("---------------------------------------------------------")
+def setup():
+    # main() starts with it, a program that imports this file calls it before balance_ring()
+    global lnd
+    lnd = lnd_client.connect()
 
-user_nodes = []
-nodes_map = {}
-for x in range(500):
-    input_channel_id = input('Enter a node id (remote pubkey): ')
-    if len(input_channel_id) == 0:
-        break
+
+def balance_ring(user_nodes, satoshi_count, chan_id_string, max_fee):
+    # Pays satoshi_count sats around the ring of user_nodes, out through chan_id_string
+    try:
+        built_route = lnd.build_route(satoshi_count, user_nodes, chan_id_string)
+    except lnd_client.LndError as err:
+        print("Failed to build the route", err)
+        exit(1)
+    if DEBUG:
+        print(built_route)
+
+    the_route = PaymentRoute(built_route)
+    max_fee_msats = int(max_fee * 1000)
+    if the_route.total_fees_msat > max_fee_msats:
+        print("Fee required is higher than max", the_route.total_fees_msat, "msats vs", max_fee_msats, "msats")
+        print(the_route.describe_fees())
+        exit(1)
+
+    if USE_KEYSEND:
+        # No invoice round trip: make the preimage here and hand it to ourselves in the route
+        preimage = os.urandom(32)
+        payment_hash = hashlib.sha256(preimage).hexdigest()
+        the_route.add_keysend(preimage.hex())
     else:
-        if "@" in input_channel_id:
-            # if the full node addr was added, let us take the pubkey part
-            elements = input_channel_id.split("@")
-            input_channel_id = elements[0]
+        invoice = create_balance_invoice(satoshi_count)
+        if DEBUG:
+            print("Invoice rhash", invoice.r_hash)
+            print("-" * 15)
+        the_route.add_invoice(invoice, satoshi_count)
+        payment_hash = invoice.r_hash
 
-        nodes_map[input_channel_id] = 1
-        user_nodes.append(input_channel_id)
-        if len(nodes_map.keys()) != len(user_nodes):
-            print("Duplicate nodes detected. Double check input.")
-            exit(1)
-print("---------------------------------------------------------")
-
-pubkey_map = {}
-for one_channel in all_channels:
-    pubkey_map[one_channel.remote_pubkey] = one_channel
-
-first_node = user_nodes[0]
-if first_node not in pubkey_map:
-    print("No active node found for the first pubkey", first_node)
-    exit(1)
-source_channel = pubkey_map[first_node]
-total_balance = source_channel.remote_balance
-total_balance += source_channel.local_balance
-half_balance = int((float(total_balance) / 2))
-est_amount = half_balance - source_channel.remote_balance
-if est_amount <= 0:
-    est_amount = 5000
-
-satoshi_count = input('How many satoshis do you want to send? (Default: {estimate}) '.format(estimate=est_amount))
-print("---------------------------------------------------------")
-if len(satoshi_count) < 0:
-    satoshi_count = est_amount
-elif len(satoshi_count) == 0:
-    satoshi_count = est_amount
-else:
-    satoshi_count = int(satoshi_count)
-
-if satoshi_count <= 0:
-    print("Are you trying to move zero satoshis? [", satoshi_count, "]")
-    exit(1)
-
-chan_id_string = input('From what channel will the funds originate? '
-                       '(Default: {expected}) '.format(
-    expected=source_channel.channel_id))
-print("---------------------------------------------------------")
-if len(chan_id_string) == 0:
-    chan_id_string = source_channel.channel_id
-
-max_fee = DEFAULT_MAX_FEE
-max_fee_string = input("What is the maximum fee you're willing to pay in satoishis?"
-                       " (Default: {fee}) ".format(
-    fee=max_fee))
-print("---------------------------------------------------------")
-if len(max_fee_string) == 0:
-    max_fee = int(DEFAULT_MAX_FEE)
-else:
-    max_fee = int(max_fee_string)
-
-if max_fee < 0:
-    max_fee = 1
-
-node_string = ",".join(user_nodes)
-route_cmd = "{lncli} buildroute --amt {amount} --hops {nodes}" \
-            " --outgoing_chan_id {channel_id}".format(
-    lncli=lncli_cmd, amount=satoshi_count, nodes=node_string, channel_id=chan_id_string)
-if DEBUG:
-    print(route_cmd)
-    print("-" * 15)
-route_command = Commandline(route_cmd)
-route_command.run()
-if len(route_command.error) > 0:
-    print("Failed to build the route", route_command.error)
-    exit(1)
-if DEBUG:
-    print(route_command.output)
-route_json = route_command.output
-route_json = route_json.replace(" ", "")
-route_json = route_json.replace("\n", "")
-route_json = route_json.replace("\r", "")
-
-the_route = PaymentRoute(route_json)
-max_fee_msats = int(max_fee * 1000)
-if the_route.total_fees_msat > max_fee_msats:
-    print("Fee required is higher than max", the_route.total_fees_msat, "msats vs", max_fee_msats, "msats")
-    print(the_route.describe_fees())
-    exit(1)
-
-invoice = create_balance_invoice(satoshi_count)
-if DEBUG:
-    print("Invoice rhash", invoice.r_hash)
-    print("-" * 15)
-
-the_route.add_invoice(invoice, satoshi_count)
-
-route_json = json.dumps(the_route.route_object)
-
-send_cmd = "{lncli} sendtoroute --payment_hash={rhash} --routes='{route}'".format(
-    lncli=lncli_cmd, rhash=invoice.r_hash, route=route_json)
-
-if DEBUG:
-    print(send_cmd)
-    print("-" * 15)
-send_command = Commandline(send_cmd)
-send_command.run()
-if len(send_command.error) > 0:
-    print("Failed to send the payment", send_command.error)
-    exit(1)
-elif len(send_command.output) > 0:
-
-    if '"code": "FEE_INSUFFICIENT"' in send_command.output:
+    try:
+        attempt = lnd.send_to_route(payment_hash, the_route.route_object["route"])
+    except lnd_client.LndError as err:
+        print("Failed to send the payment", err)
+        exit(1)
+
+    failure = attempt.get("failure") or {}
+    if failure.get("code") == "FEE_INSUFFICIENT":
         print("Balance failed because the fee was too low.")
-    elif '"status": "SUCCEEDED",' in send_command.output:
+    elif attempt.get("status") == "SUCCEEDED":
         print("Success")
         fee_str = the_route.recover_fees()
         if len(fee_str) > 0:
@@ -340,8 +212,124 @@ elif len(send_command.output) > 0:
             print("No fees worth recovering.")
             print(the_route.describe_fees())
         if DEBUG:
-            print(send_command.output)
+            print(json.dumps(attempt, indent=4))
     else:
         print("Unexpected response:")
-        print(send_command.output)
+        print(json.dumps(attempt, indent=4))
         print("-" * 15)
+
+
+def read_node_ids(node_list):
+    # The ring from --nodes, or asked one node at a time
+    if node_list is not None:
+        node_ids = [x.strip() for x in node_list.split(",") if len(x.strip()) > 0]
+    else:
+        print("Enter all of the node ids in your ring.")
+        print("Start with the node where you have outbound liquidity.")
+        print("End with your node.")
+        print("---------------------------------------------------------")
+        print("Signal that you're done entering nodes with a blank line.")
+        print("---------------------------------------------------------")
+        node_ids = []
+        for x in range(500):
+            input_channel_id = input('Enter a node id (remote pubkey): ')
+            if len(input_channel_id) == 0:
+                break
+            node_ids.append(input_channel_id)
+
+    user_nodes = []
+    nodes_map = {}
+    for input_channel_id in node_ids:
+        if "@" in input_channel_id:
+            # if the full node addr was added, let us take the pubkey part
+            elements = input_channel_id.split("@")
+            input_channel_id = elements[0]
+
+        nodes_map[input_channel_id] = 1
+        user_nodes.append(input_channel_id)
+        if len(nodes_map.keys()) != len(user_nodes):
+            print("Duplicate nodes detected. Double check input.")
+            exit(1)
+    print("---------------------------------------------------------")
+    return user_nodes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pay sats around a ring of nodes, ending with your own node.")
+    parser.add_argument("--nodes",
+                        help="the node ids of the ring, separated by commas: first the node where you have "
+                             "outbound liquidity, last your own node")
+    parser.add_argument("--amount", type=int, help="satoshis to send (default: half the first channel's imbalance)")
+    parser.add_argument("--channel", help="the channel the funds leave from (default: the first node's channel)")
+    parser.add_argument("--max-fee", type=int,
+                        help="most satoshis to pay in fees (default: {fee})".format(fee=DEFAULT_MAX_FEE))
+    args = parser.parse_args(argv)
+
+    setup()
+    all_channels = get_channels()
+    user_nodes = read_node_ids(args.nodes)
+    if len(user_nodes) == 0:
+        print("No nodes entered")
+        exit(1)
+
+    pubkey_map = {}
+    for one_channel in all_channels:
+        pubkey_map[one_channel.remote_pubkey] = one_channel
+
+    first_node = user_nodes[0]
+    if first_node not in pubkey_map:
+        print("No active node found for the first pubkey", first_node)
+        exit(1)
+    source_channel = pubkey_map[first_node]
+    total_balance = source_channel.remote_balance
+    total_balance += source_channel.local_balance
+    half_balance = int((float(total_balance) / 2))
+    est_amount = half_balance - source_channel.remote_balance
+    if est_amount <= 0:
+        est_amount = 5000
+
+    if args.amount is not None:
+        satoshi_count = args.amount
+    else:
+        satoshi_count = input('How many satoshis do you want to send? (Default: {estimate}) '.format(
+            estimate=est_amount))
+        print("---------------------------------------------------------")
+        if len(satoshi_count) == 0:
+            satoshi_count = est_amount
+        else:
+            satoshi_count = int(satoshi_count)
+
+    if satoshi_count <= 0:
+        print("Are you trying to move zero satoshis? [", satoshi_count, "]")
+        exit(1)
+
+    if args.channel is not None:
+        chan_id_string = args.channel
+    else:
+        chan_id_string = input('From what channel will the funds originate? '
+                               '(Default: {expected}) '.format(
+            expected=source_channel.channel_id))
+        print("---------------------------------------------------------")
+        if len(chan_id_string) == 0:
+            chan_id_string = source_channel.channel_id
+
+    if args.max_fee is not None:
+        max_fee = args.max_fee
+    else:
+        max_fee_string = input("What is the maximum fee you're willing to pay in satoishis?"
+                               " (Default: {fee}) ".format(
+            fee=DEFAULT_MAX_FEE))
+        print("---------------------------------------------------------")
+        if len(max_fee_string) == 0:
+            max_fee = int(DEFAULT_MAX_FEE)
+        else:
+            max_fee = int(max_fee_string)
+
+    if max_fee < 0:
+        max_fee = 1
+
+    balance_ring(user_nodes, satoshi_count, chan_id_string, max_fee)
+
+
+if __name__ == "__main__":
+    main()